@@ -35,11 +35,35 @@ stop_event = threading.Event()
 # HTTP helpers
 # ---------------------------------------------------------------------------
 
-def rca_get(path: str, **kwargs):
+# cache per GET condizionali (If-None-Match): una voce per url -> (params, etag, body, headers);
+# parametri che cambiano a ogni richiesta (es. ?since=) sostituiscono la voce, non la moltiplicano
+_etag_cache_lock = threading.Lock()
+_etag_cache: Dict[str, Tuple[str, str, Any, Dict[str, str]]] = {}
+
+def rca_get(path: str, return_headers: bool = False, **kwargs):
     url = RCA_BASE_URL + path
-    r = requests.get(url, timeout=5, **kwargs)
-    r.raise_for_status()
-    return r.json()
+    params_key = json.dumps(kwargs.get("params") or {}, sort_keys=True)
+    headers = dict(kwargs.pop("headers", None) or {})
+    with _etag_cache_lock:
+        cached = _etag_cache.get(url)
+    if cached and cached[0] == params_key:
+        cached = cached[1:]
+        headers["If-None-Match"] = cached[0]
+    else:
+        cached = None
+
+    r = requests.get(url, timeout=5, headers=headers, **kwargs)
+    if r.status_code == 304 and cached:
+        # risposta invariata: nessun download né parsing JSON
+        data, resp_headers = cached[1], dict(cached[2], **r.headers)
+    else:
+        r.raise_for_status()
+        data, resp_headers = r.json(), dict(r.headers)
+        etag = r.headers.get("ETag")
+        if etag:
+            with _etag_cache_lock:
+                _etag_cache[url] = (params_key, etag, data, resp_headers)
+    return (data, resp_headers) if return_headers else data
 
 def rca_post(path: str, json_body: Optional[dict] = None):
     url = RCA_BASE_URL + path
@@ -61,7 +85,7 @@ def on_mqtt_connect(client, userdata, flags, rc):
     if rc == 0:
         with alerts_lock:
             alerts.append(("INFO", "[MQTT] Connesso, sottoscrizione agli alert..."))
-        client.subscribe(MQTT_ALERT_TOPIC)
+        client.subscribe(MQTT_ALERT_TOPIC, qos=1)
     else:
         with alerts_lock:
             alerts.append(("ERROR", f"[MQTT] Errore connessione (rc={rc})"))
@@ -72,11 +96,18 @@ def on_mqtt_message(client, userdata, msg):
     except Exception:
         payload = {"raw": msg.payload.decode("utf-8", errors="ignore")}
 
+    # RCA accorpa gli alert dello stesso topic in una lista
+    for item in payload if isinstance(payload, list) else [payload]:
+        show_alert(item)
+
+def show_alert(payload):
     level = payload.get("level", "info").upper()
     ugrid_id = payload.get("ugrid_id", "?")
     bat = payload.get("battery_index", "?")
     message = payload.get("message", "")
     ts = payload.get("timestamp", "")
+    if payload.get("event") == "resolved":
+        level = "INFO"
 
     text = f"{ts}  {ugrid_id}/bat{bat}: {message}"
     with alerts_lock:
@@ -102,13 +133,40 @@ def start_mqtt_listener():
 # THREAD DI POLLING STATO
 # ---------------------------------------------------------------------------
 
+def merge_status_delta(base: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    merged = dict(base)
+    for ugrid_id, info in delta.items():
+        if info is None:
+            merged.pop(ugrid_id, None)  # uGrid rimossa dall'RCA
+            continue
+        old = merged.get(ugrid_id, {})
+        batts = {b.get("index"): b for b in old.get("batteries", [])}
+        for b in info.get("batteries", []):
+            batts[b.get("index")] = b
+        new = dict(old, **{k: v for k, v in info.items() if k != "batteries"})
+        new["batteries"] = [batts[i] for i in sorted(batts, key=lambda x: (x is None, x))]
+        merged[ugrid_id] = new
+    return merged
+
 def poll_status_loop():
+    global status_data
+    version: Optional[str] = None
+    instance: Optional[str] = None
     while not stop_event.is_set():
         try:
-            data = rca_get("/api/status")
+            params = {"since": version} if version is not None else None
+            data, headers = rca_get("/api/status", params=params, return_headers=True)
+            new_instance = headers.get("X-Status-Instance")
+            if params is not None and new_instance != instance:
+                # RCA riavviata: le versioni ripartono, serve lo stato completo
+                version, instance = None, new_instance
+                continue
             with status_data_lock:
-                global status_data
-                status_data = data
+                # senza X-Status-Since l'RCA ha risposto con lo stato completo (es. sharding)
+                is_delta = params is not None and headers.get("X-Status-Since") is not None
+                status_data = merge_status_delta(status_data, data) if is_delta else data
+            version = headers.get("X-Status-Version")
+            instance = new_instance
         except Exception as e:
             with alerts_lock:
                 alerts.append(("ERROR", f"[RCA] Errore lettura /api/status: {e}"))
@@ -1,19 +1,43 @@
+import bisect
+import gzip
+import hashlib
+import heapq
+import ipaddress
 import json
 import logging
+import os
+import random
+import re
 import signal
 import sys
 import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
+from queue import Empty, Full, Queue
 from urllib.parse import urlparse
-from datetime import datetime
+from urllib.request import urlopen
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from typing import Optional, Dict, Any, Tuple, Union
 
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, jsonify, request, abort
 import mysql.connector
+import numpy as np
 import paho.mqtt.client as mqtt
 from coapthon.client.helperclient import HelperClient
 from coapthon import defines
+from coapthon.utils import generate_random_token
 import cbor2
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # ---------------------------------------------------------------------------
 # CONFIGURAZIONE
@@ -28,20 +52,98 @@ MYSQL_CONFIG = {
 }
 DB_NAME = "ugrid"
 DROP_SCHEMA_ON_STARTUP = False 
+DB_READ_POOL_SIZE = 8             # connessioni massime per le letture (API)
+DB_WRITE_POOL_SIZE = 4            # connessioni massime per le scritture
+DB_POOL_TIMEOUT_SEC = 5.0         # attesa massima per una connessione libera
+DB_POOL_VALIDATE_IDLE_SEC = 30.0  # ping prima del prestito se inattiva da più di N secondi
+
+# Schema telemetria: "plain" (tabella singola) o "timeseries" (partizioni giornaliere)
+TELEMETRY_SCHEMA_MODE = "timeseries"
+TELEMETRY_RETENTION_DAYS = 90           # partizioni più vecchie vengono eliminate (DROP PARTITION)
+TELEMETRY_PARTITIONS_AHEAD_DAYS = 3     # partizioni create in anticipo
+PARTITION_MAINTENANCE_INTERVAL_SEC = 3600.0
+
+# Rollup incrementali della telemetria: (nome, ampiezza bucket in secondi, retention in giorni)
+ROLLUP_TIERS = (
+    ("1m", 60, 14),
+    ("15m", 900, 180),
+    ("1h", 3600, 1825),
+)
+ROLLUP_METRICS = ("soc", "soh", "temperature", "power_kw")  # min/max/avg per bucket
+
+# History bucketizzata (/api/batteries/<ugrid>/<idx>/history?from=&to=&step=)
+HISTORY_DEFAULT_POINTS = 500
+HISTORY_MAX_POINTS = 2000
+HISTORY_LTTB_OVERSAMPLE = 4   # bucket candidati per punto restituito con agg=lttb
+API_MAX_PAGE_SIZE = 1000      # righe massime per pagina JSON (NDJSON in streaming non ha limite)
+
+# Codifica risposte API: JSON, CBOR o MessagePack (Accept) + compressione (Accept-Encoding)
+API_COMPRESS_MIN_BYTES = 2048
+API_GZIP_LEVEL = 5
+API_ZSTD_LEVEL = 3
+
+# Server-Sent Events (/api/stream)
+SSE_HEARTBEAT_SEC = 15.0
+SSE_HISTORY_SIZE = 1000       # eventi conservati per la ripresa tramite Last-Event-ID
+SSE_RETRY_MS = 3000
+
+# Scrittura telemetria asincrona (write-behind)
+TELEMETRY_QUEUE_MAX = 20000            # righe in coda prima di applicare la policy di overflow
+TELEMETRY_BATCH_SIZE = 500             # righe per INSERT multi-riga
+TELEMETRY_FLUSH_INTERVAL_SEC = 1.0     # flush anche con batch incompleto
+TELEMETRY_ENQUEUE_TIMEOUT_SEC = 0.05   # back-pressure massima sul poll thread
+TELEMETRY_OVERFLOW_POLICY = "spill"    # "spill" | "drop_oldest" | "drop_newest"
+TELEMETRY_SPILL_PATH = "telemetry_spill.jsonl"
+TELEMETRY_RETRY_BACKOFF_SEC = 2.0
+TELEMETRY_REPLAY_BACKOFF_MAX_SEC = 300.0  # attesa massima tra tentativi di replay con il DB giù
 
 # MQTT
 MQTT_BROKER_HOST = "localhost"
 MQTT_BROKER_PORT = 1883
 MQTT_ALERT_TOPIC_BASE = "ugrid/alerts"
-
-UGRIDS = {
+MQTT_QOS = 1                      # 0 = best effort, 1 = almeno una volta
+MQTT_QUEUE_MAX = 10000            # coda in uscita; oltre si scrive direttamente su disco
+MQTT_BATCH_WINDOW_SEC = 0.2       # attesa per accorpare messaggi sullo stesso topic
+MQTT_BATCH_MAX = 100              # messaggi massimi per pubblicazione
+MQTT_SPOOL_PATH = "mqtt_spool.jsonl"  # buffer su disco mentre il broker non è raggiungibile
+MQTT_SPOOL_REPLAY_BATCH = 50      # batch dello spool ripubblicati per giro del publisher
+# Snapshot telemetria per uGrid: CBOR con la codifica di /dev/state, retained, ultimo valore vince
+MQTT_TELEMETRY_ENABLED = True
+MQTT_TELEMETRY_TOPIC_BASE = "ugrid/telemetry"
+MQTT_TELEMETRY_QOS = 0
+
+# Registro uGrid nella tabella ugrids; queste voci la popolano solo al primo avvio
+UGRIDS_SEED = {
     "ug1": {
         "coap_state_uri": "coap://[fd00::f6ce:36ac:9afa:6be2]/dev/state",
     },
 }
 
+# Discovery: elenco route del border router + /.well-known/core di ogni nodo
+DISCOVERY_BORDER_ROUTER_URL: Optional[str] = None  # es. "http://[fd00::201:1:1:1]/"
+DISCOVERY_INTERVAL_SEC = 300.0
+DISCOVERY_COAP_TIMEOUT_SEC = 2.0
+
 # Polling
-POLL_INTERVAL_SEC = 5.0
+POLL_INTERVAL_SEC = 5.0           # intervallo base (e tick di supervisione observe/registro)
+POLL_INTERVAL_ACTIVE_SEC = 2.0    # uGrid con obiettivi attivi
+POLL_INTERVAL_IDLE_SEC = 15.0     # uGrid senza obiettivi e batterie ferme
+POLL_IDLE_POWER_KW = 0.05         # sotto questa potenza totale batterie la uGrid è "ferma"
+POLL_JITTER_FRAC = 0.1            # ±10% su ogni scadenza, fase iniziale casuale
+POLL_BACKOFF_MAX_SEC = 300.0      # tetto del backoff esponenziale sui fallimenti
+POLL_TIMEOUT_SEC = 3.0     # deadline per singola uGrid
+POLL_MAX_WORKERS = 16      # GET /dev/state concorrenti
+
+# Ingest: "poll" (GET periodiche) oppure "observe" (CoAP Observe con fallback a poll)
+INGEST_MODE = "observe"
+OBSERVE_MAX_SILENCE_SEC = 3 * POLL_INTERVAL_SEC  # senza notifiche oltre questa soglia si ri-registra
+OBSERVE_MAX_FAILURES = 3                         # ri-registrazioni fallite prima del fallback a poll
+OBSERVE_RETRY_SEC = 60.0                         # durata del fallback a poll prima di ritentare
+
+# Pool client CoAP (un HelperClient persistente per endpoint)
+COAP_POOL_IDLE_TIMEOUT_SEC = 120.0   # client inutilizzati oltre questa soglia vengono chiusi
+COAP_POOL_SWEEP_INTERVAL_SEC = 30.0
+COAP_POOL_MAX_FAILURES = 3           # errori consecutivi prima di ricreare il client
 CONTENT_FORMAT_CBOR = 60  
 CONTENT_FORMAT_JSON = 50  
 ENERGY_PRICE_EUR_PER_KWH = 0.25
@@ -51,6 +153,55 @@ TEMP_HIGH_CRITICAL = 50.0
 MAX_CHARGE_POWER_KW = 5.0   
 MAX_DISCH_POWER_KW  = -5.0  
 
+# Dispatch obiettivi: PUT /ctrl/obj asincroni, solo su variazioni reali del setpoint
+OBJ_DEADBAND_KW = 0.1          # variazioni di setpoint entro questa soglia non vengono inviate
+OBJ_REFRESH_SEC = 60.0         # ritrasmette comunque un setpoint confermato più vecchio di così
+OBJ_DISPATCH_WORKERS = 8       # PUT concorrenti (una sola in volo per batteria)
+OBJ_PUT_TIMEOUT_SEC = 3.0
+OBJ_MAX_RETRIES = 3
+OBJ_RETRY_BACKOFF_SEC = 0.5    # raddoppia a ogni tentativo
+
+# Regole alert nella tabella alert_rules; queste le popolano solo al primo avvio.
+# Isteresi: si apre oltre "enter", si chiude solo rientrando oltre "exit".
+# kind "rate": confronto sulla derivata del campo, in unità al minuto.
+ALERT_RULES_SEED = (
+    {"rule_id": "soh_low", "level": "critical", "field": "soh", "kind": "threshold", "op": "<",
+     "enter": SOH_LOW_CRITICAL, "exit": SOH_LOW_CRITICAL + 0.02, "message": "SoH critico {value:.1%}"},
+    {"rule_id": "temp_high", "level": "critical", "field": "temperature", "kind": "threshold", "op": ">",
+     "enter": TEMP_HIGH_CRITICAL, "exit": TEMP_HIGH_CRITICAL - 5.0, "message": "Temp alta {value:.1f}°C"},
+    {"rule_id": "soc_low", "level": "warning", "field": "soc", "kind": "threshold", "op": "<",
+     "enter": SOC_LOW_WARNING, "exit": SOC_LOW_WARNING + 0.05, "message": "SoC basso {value:.1%}"},
+    {"rule_id": "temp_rise", "level": "warning", "field": "temperature", "kind": "rate", "op": ">",
+     "enter": 2.0, "exit": 0.5, "message": "Temperatura in rapida salita {value:.2f}°C/min"},
+)
+ALERT_LEVELS = ("info", "warning", "critical")
+ALERT_REMINDER_SEC = 3600.0   # promemoria "ancora attivo" (con contatore) per incidenti aperti
+ALERT_COOLDOWN_SEC = 600.0    # rientro entro questo tempo dalla chiusura: riapre lo stesso alert senza notifica
+
+# Server HTTP: "dev" (server Flask), "waitress" (WSGI multi-thread) o "gunicorn" (multi-processo)
+HTTP_SERVER = "dev"
+HTTP_HOST = "0.0.0.0"
+HTTP_PORT = 3000
+HTTP_WORKERS = 4               # processi gunicorn
+HTTP_THREADS = 8               # thread per processo (gunicorn gthread / waitress)
+# Ogni stream SSE occupa un thread per tutta la connessione: oltre il limite /api/stream
+# risponde 503, così resta almeno metà dei thread per le altre API
+SSE_MAX_SUBSCRIBERS = max(1, HTTP_THREADS // 2)  # per processo
+HTTP_WORKER_TIMEOUT_SEC = 30   # watchdog gunicorn (gthread: heartbeat indipendente dalle richieste)
+# Con più processi un solo worker (leader, lock MySQL) esegue il poll engine; lo stato
+# condiviso passa dalla tabella rca_shared_state
+SHARED_STATE_SYNC_SEC = 1.0    # controllo versioni stato condiviso
+SHARED_STATE_PUBLISH_SEC = 1.0 # pubblicazione snapshot dal leader
+SHARED_STATE_LEAD_RETRY_SEC = 5.0  # tentativi GET_LOCK dei non leader (±50% jitter)
+
+# Sharding: N nodi RCA si dividono le uGrid con un hash ring consistente;
+# membership tramite lease nella tabella rca_nodes
+SHARD_ENABLED = False
+RCA_NODE_ID = os.environ.get("RCA_NODE_ID", "rca")  # univoco per nodo
+SHARD_LEASE_TTL_SEC = 15.0     # nodo considerato morto dopo questo tempo senza heartbeat
+SHARD_VNODES = 64              # punti sul ring per nodo
+ENGINE_LOCK_NAME = f"rca_poll_engine:{RCA_NODE_ID}"  # leader del poll engine, uno per nodo
+
 logging.basicConfig(
     level=logging.INFO,
     format="[%(asctime)s] %(levelname)s %(name)s: %(message)s",
@@ -59,6 +210,42 @@ logger = logging.getLogger("RCA")
 
 app = Flask(__name__)
 
+# ---------------------------------------------------------------------------
+# LOCK STRUMENTATI
+# ---------------------------------------------------------------------------
+
+class InstrumentedLock:
+    # threading.Lock con contatori di contesa, esposti su /api/stats
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.max_hold = 0.0
+
+    def __enter__(self):
+        if not self._lock.acquire(blocking=False):
+            t0 = time.perf_counter()
+            self._lock.acquire()
+            self.contended += 1
+            self.wait_time += time.perf_counter() - t0
+        self.acquisitions += 1
+        self._acquired_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self._acquired_at
+        if held > self.max_hold:
+            self.max_hold = held
+        self._lock.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"acquisitions": self.acquisitions, "contended": self.contended,
+                "wait_time_sec": round(self.wait_time, 4),
+                "max_hold_ms": round(self.max_hold * 1000, 3)}
+
 # ---------------------------------------------------------------------------
 # HELPERS MYSQL
 # ---------------------------------------------------------------------------
@@ -70,6 +257,156 @@ def get_mysql_connection(database=None):
     return mysql.connector.connect(**cfg)
 
 
+class MySQLPool:
+    def __init__(self, database: str, size: int):
+        self.database = database
+        self.size = size
+        self._idle: deque = deque()  # (conn, last_used), LIFO
+        self._open = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "borrows": 0, "waits": 0, "wait_time_sec": 0.0, "timeouts": 0,
+            "created": 0, "validations": 0, "reconnects": 0, "discarded": 0,
+        }
+
+    def _connect(self):
+        conn = get_mysql_connection(self.database)
+        # autocommit: evita snapshot REPEATABLE READ vecchi sulle connessioni riusate
+        conn.autocommit = True
+        self._stats["created"] += 1
+        return conn
+
+    def _validate(self, conn):
+        self._stats["validations"] += 1
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except Exception:
+            pass
+        logger.warning("Connessione MySQL non valida, riconnessione")
+        self._close_quietly(conn)
+        conn = self._connect()
+        self._stats["reconnects"] += 1
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _borrow(self):
+        start = time.time()
+        deadline = start + DB_POOL_TIMEOUT_SEC
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise mysql.connector.errors.PoolError("Pool MySQL esaurito (timeout)")
+                waited = True
+                self._cond.wait(remaining)
+            self._stats["borrows"] += 1
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_time_sec"] += time.time() - start
+
+        try:
+            if conn is None:
+                return self._connect()
+            # is_connected() farebbe un ping a ogni prestito: si valida solo dopo inattività,
+            # una connessione caduta fallisce la query e _release(failed) la scarta
+            if time.time() - last_used > DB_POOL_VALIDATE_IDLE_SEC:
+                return self._validate(conn)
+            return conn
+        except Exception:
+            self._discard(None)
+            raise
+
+    def _discard(self, conn):
+        if conn is not None:
+            self._close_quietly(conn)
+        with self._cond:
+            self._open -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    def _release(self, conn, failed: bool):
+        try:
+            if conn.unread_result:
+                if failed:
+                    # es. streaming interrotto: meglio chiudere che leggere il resto del risultato
+                    raise RuntimeError("risultato non letto")
+                conn.consume_results()
+            if failed:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self._borrow()
+        failed = True
+        try:
+            yield conn
+            failed = False
+        finally:
+            self._release(conn, failed)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            out = dict(self._stats)
+            out.update({"size": self.size, "open": self._open, "idle": len(self._idle),
+                        "in_use": self._open - len(self._idle)})
+        out["wait_time_sec"] = round(out["wait_time_sec"], 3)
+        return out
+
+    def take(self):
+        # Connessione sottratta al pool (es. sessione che tiene un GET_LOCK): il posto
+        # si libera subito, la connessione torna con give_back() o va chiusa dal chiamante
+        conn = self._borrow()
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+        return conn
+
+    def give_back(self, conn):
+        with self._cond:
+            if self._open < self.size:
+                self._open += 1
+                self._idle.append((conn, time.time()))
+                self._cond.notify()
+                return
+        self._close_quietly(conn)
+
+    def close_all(self):
+        with self._cond:
+            idle = [c for c, _ in self._idle]
+            self._idle.clear()
+            self._open -= len(idle)
+        for conn in idle:
+            self._close_quietly(conn)
+
+
+# Letture (API, caricamenti a freddo) e scritture (writer telemetria, alert, obiettivi, DDL)
+# usano pool distinti: una raffica di insert non esaurisce le connessioni delle API
+db_read_pool = MySQLPool(DB_NAME, DB_READ_POOL_SIZE)
+db_write_pool = MySQLPool(DB_NAME, DB_WRITE_POOL_SIZE)
+
+
 def init_database():
     conn = get_mysql_connection()
     conn.autocommit = True
@@ -89,13 +426,23 @@ def init_database():
         cur.execute("DROP TABLE IF EXISTS objectives")
         cur.execute("DROP TABLE IF EXISTS mpc_params")
         cur.execute("DROP TABLE IF EXISTS telemetry")
-
-    cur.execute("""
+        cur.execute("DROP TABLE IF EXISTS rca_shared_state")
+        cur.execute("DROP TABLE IF EXISTS rca_nodes")
+        cur.execute("DROP TABLE IF EXISTS ugrids")
+        cur.execute("DROP TABLE IF EXISTS alert_rules")
+        for name, _, _ in ROLLUP_TIERS:
+            cur.execute(f"DROP TABLE IF EXISTS telemetry_{name}")
+
+    if TELEMETRY_SCHEMA_MODE == "timeseries":
+        pk, partitions = "PRIMARY KEY (id, ts)", "\n        " + _telemetry_partitions_ddl(date.today())
+    else:
+        pk, partitions = "PRIMARY KEY (id)", ""
+    cur.execute(f"""
         CREATE TABLE IF NOT EXISTS telemetry (
-            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            id BIGINT AUTO_INCREMENT,
             ugrid_id      VARCHAR(64) NOT NULL,
             battery_index INT         NOT NULL,
-            ts            TIMESTAMP   DEFAULT CURRENT_TIMESTAMP,
+            ts            TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
             soc           FLOAT,
             soh           FLOAT,
             voltage       FLOAT,
@@ -106,9 +453,33 @@ def init_database():
             grid_power_kw FLOAT,
             load_kw       FLOAT,
             pv_kw         FLOAT,
-            profit_eur    FLOAT
-        ) ENGINE=InnoDB
+            profit_eur    FLOAT,
+            {pk},
+            INDEX idx_telemetry_batt_ts (ugrid_id, battery_index, ts)
+        ) ENGINE=InnoDB{partitions}
     """)
+    migrate_telemetry_schema(cur)
+
+    metric_cols = ",\n            ".join(
+        f"{m}_min FLOAT, {m}_max FLOAT, {m}_sum DOUBLE, {m}_n INT NOT NULL DEFAULT 0"
+        for m in ROLLUP_METRICS)
+    for name, _, _ in ROLLUP_TIERS:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS telemetry_{name} (
+                ugrid_id      VARCHAR(64) NOT NULL,
+                battery_index INT         NOT NULL,
+                bucket_ts     TIMESTAMP   NOT NULL,
+                samples       INT         NOT NULL,
+                {metric_cols},
+                profit_eur    DOUBLE,
+                PRIMARY KEY (ugrid_id, battery_index, bucket_ts)
+            ) ENGINE=InnoDB
+        """)
+        for m in ROLLUP_METRICS:
+            # {m}_n: campioni non NULL della metrica, denominatore della media
+            if ensure_column(cur, f"telemetry_{name}", f"{m}_n", "INT NOT NULL DEFAULT 0"):
+                # bucket preesistenti: stima (tutti i campioni, se la somma c'è)
+                cur.execute(f"UPDATE telemetry_{name} SET {m}_n = samples WHERE {m}_sum IS NOT NULL")
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS objectives (
@@ -140,7 +511,80 @@ def init_database():
             battery_index INT,
             ts            TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             message       TEXT,
-            payload       JSON
+            payload       JSON,
+            rule_id       VARCHAR(32),
+            state         VARCHAR(16),
+            occurrences   INT NOT NULL DEFAULT 1,
+            last_ts       TIMESTAMP NULL,
+            resolved_at   TIMESTAMP NULL,
+            INDEX idx_alerts_ts (ts),
+            INDEX idx_alerts_state (state)
+        ) ENGINE=InnoDB
+    """)
+    ensure_index(cur, "alerts", "idx_alerts_ts", "ts")
+    for column, ddl in (("rule_id", "VARCHAR(32)"), ("state", "VARCHAR(16)"),
+                        ("occurrences", "INT NOT NULL DEFAULT 1"), ("last_ts", "TIMESTAMP NULL"),
+                        ("resolved_at", "TIMESTAMP NULL")):
+        ensure_column(cur, "alerts", column, ddl)
+    ensure_index(cur, "alerts", "idx_alerts_state", "state")
+    # eventi puntuali scritti senza stato dalle versioni precedenti
+    cur.execute("UPDATE alerts SET state='resolved', resolved_at=COALESCE(resolved_at, ts) WHERE state IS NULL")
+
+    # Regole alert: ugrid_id '' e battery_index -1 = valida per tutte (override più specifico vince)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS alert_rules (
+            id            BIGINT AUTO_INCREMENT PRIMARY KEY,
+            rule_id       VARCHAR(32)  NOT NULL,
+            ugrid_id      VARCHAR(64)  NOT NULL DEFAULT '',
+            battery_index INT          NOT NULL DEFAULT -1,
+            level         VARCHAR(16)  NOT NULL,
+            field         VARCHAR(32)  NOT NULL,
+            kind          VARCHAR(16)  NOT NULL DEFAULT 'threshold',
+            op            CHAR(1)      NOT NULL,
+            enter_value   DOUBLE       NOT NULL,
+            exit_value    DOUBLE       NOT NULL,
+            message       VARCHAR(255) NOT NULL,
+            enabled       TINYINT(1)   NOT NULL DEFAULT 1,
+            updated_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_alert_rules_scope (rule_id, ugrid_id, battery_index)
+        ) ENGINE=InnoDB
+    """)
+    cur.execute("SELECT COUNT(*) FROM alert_rules")
+    if cur.fetchone()[0] == 0:
+        cur.executemany("""
+            INSERT INTO alert_rules (rule_id, level, field, kind, op, enter_value, exit_value, message)
+            VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+        """, [(r["rule_id"], r["level"], r["field"], r["kind"], r["op"], r["enter"], r["exit"], r["message"])
+              for r in ALERT_RULES_SEED])
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ugrids (
+            ugrid_id       VARCHAR(64)  PRIMARY KEY,
+            coap_state_uri VARCHAR(255) NOT NULL,
+            source         VARCHAR(16)  NOT NULL DEFAULT 'api',
+            created_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_ugrids_uri (coap_state_uri)
+        ) ENGINE=InnoDB
+    """)
+    cur.executemany(
+        "INSERT IGNORE INTO ugrids (ugrid_id, coap_state_uri, source) VALUES (%s, %s, 'static')",
+        [(ug, cfg["coap_state_uri"]) for ug, cfg in UGRIDS_SEED.items()])
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS rca_shared_state (
+            name       VARCHAR(64) PRIMARY KEY,
+            version    BIGINT      NOT NULL,
+            body       LONGBLOB,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS rca_nodes (
+            node_id    VARCHAR(64) PRIMARY KEY,
+            expires_at DOUBLE      NOT NULL,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         ) ENGINE=InnoDB
     """)
 
@@ -149,6 +593,488 @@ def init_database():
     logger.info("Database inizializzato")
 
 
+# ---------------------------------------------------------------------------
+# SCHEMA TIME-SERIES (indice composito, partizioni giornaliere, retention)
+# ---------------------------------------------------------------------------
+
+def _telemetry_partition_ddl(day: date) -> str:
+    # pYYYYMMDD contiene i campioni del giorno 'day' (limite superiore: mezzanotte successiva)
+    upper = (day + timedelta(days=1)).isoformat()
+    return f"PARTITION p{day:%Y%m%d} VALUES LESS THAN (UNIX_TIMESTAMP('{upper} 00:00:00'))"
+
+def _telemetry_partitions_ddl(first_day: date) -> str:
+    parts = [_telemetry_partition_ddl(first_day + timedelta(days=i))
+             for i in range(TELEMETRY_PARTITIONS_AHEAD_DAYS + 1)]
+    parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return "PARTITION BY RANGE (UNIX_TIMESTAMP(ts)) (\n            " + ",\n            ".join(parts) + "\n        )"
+
+def _telemetry_partitions(cur) -> Dict[str, str]:
+    cur.execute("""
+        SELECT partition_name, partition_description FROM information_schema.partitions
+        WHERE table_schema=%s AND table_name='telemetry' AND partition_name IS NOT NULL
+        ORDER BY partition_ordinal_position
+    """, (DB_NAME,))
+    return {name: desc for name, desc in cur.fetchall()}
+
+def ensure_index(cur, table: str, name: str, columns: str):
+    cur.execute("""
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema=%s AND table_name=%s AND index_name=%s
+    """, (DB_NAME, table, name))
+    if cur.fetchone()[0] == 0:
+        logger.warning(f"Migrazione {table}: creazione indice {name} ({columns})")
+        cur.execute(f"ALTER TABLE {table} ADD INDEX {name} ({columns})")
+
+def ensure_column(cur, table: str, name: str, ddl: str):
+    cur.execute("""
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema=%s AND table_name=%s AND column_name=%s
+    """, (DB_NAME, table, name))
+    if cur.fetchone()[0] == 0:
+        logger.warning(f"Migrazione {table}: aggiunta colonna {name} {ddl}")
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+        return True
+    return False
+
+def migrate_telemetry_schema(cur):
+    # Database creati con lo schema originale: aggiunge indice e, se richiesto, partizionamento
+    ensure_index(cur, "telemetry", "idx_telemetry_batt_ts", "ugrid_id, battery_index, ts")
+
+    if TELEMETRY_SCHEMA_MODE != "timeseries" or _telemetry_partitions(cur):
+        return
+
+    # La chiave di partizionamento deve far parte della PRIMARY KEY.
+    # Tutto lo storico esistente finisce nella prima partizione (giorno corrente).
+    logger.warning("Migrazione telemetry: partizionamento per giorno (può richiedere tempo)")
+    cur.execute("""
+        ALTER TABLE telemetry
+            MODIFY ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            DROP PRIMARY KEY,
+            ADD PRIMARY KEY (id, ts)
+    """)
+    cur.execute("ALTER TABLE telemetry " + _telemetry_partitions_ddl(date.today()))
+    logger.info("Migrazione telemetry completata")
+
+def maintain_telemetry_partitions():
+    with db_write_pool.connection() as conn:
+        cur = conn.cursor()
+        parts = _telemetry_partitions(cur)
+        if not parts:
+            return
+
+        cur.execute("SELECT UNIX_TIMESTAMP(CURDATE() - INTERVAL %s DAY), CURDATE()",
+                    (TELEMETRY_RETENTION_DAYS,))
+        cutoff, today = cur.fetchone()
+
+        # Partizioni future: si divide pmax finché non si coprono i giorni richiesti
+        bounded = {name: int(desc) for name, desc in parts.items() if desc != "MAXVALUE"}
+        last_day = max((datetime.strptime(n[1:], "%Y%m%d").date() for n in bounded if n[1:].isdigit()),
+                       default=today - timedelta(days=1))
+        while last_day < today + timedelta(days=TELEMETRY_PARTITIONS_AHEAD_DAYS):
+            last_day += timedelta(days=1)
+            cur.execute(f"""
+                ALTER TABLE telemetry REORGANIZE PARTITION pmax INTO (
+                    {_telemetry_partition_ddl(last_day)},
+                    PARTITION pmax VALUES LESS THAN MAXVALUE
+                )
+            """)
+            logger.info(f"Creata partizione telemetry p{last_day:%Y%m%d}")
+
+        # Retention: DROP PARTITION invece di DELETE
+        expired = [name for name, upper in bounded.items() if upper <= cutoff]
+        if len(expired) >= len(bounded):
+            expired = expired[:-1]  # mantiene sempre almeno una partizione limitata
+        for name in expired:
+            cur.execute(f"ALTER TABLE telemetry DROP PARTITION {name}")
+            logger.info(f"Retention telemetry: eliminata partizione {name}")
+        cur.close()
+
+
+# ---------------------------------------------------------------------------
+# TELEMETRIA WRITE-BEHIND
+# ---------------------------------------------------------------------------
+
+TELEMETRY_COLUMNS = (
+    "ugrid_id", "battery_index", "ts", "soc", "soh", "voltage", "temperature",
+    "current", "power_kw", "optimal_u_kw", "grid_power_kw", "load_kw", "pv_kw", "profit_eur",
+)
+_TELEMETRY_COL = {name: i for i, name in enumerate(TELEMETRY_COLUMNS)}
+_TELEMETRY_ROW_FIELDS = TELEMETRY_COLUMNS[3:]
+_TELEMETRY_ROW_SQL = "(" + ",".join(["%s"] * len(TELEMETRY_COLUMNS)) + ")"
+_ROLLUP_METRIC_POS = tuple(TELEMETRY_COLUMNS.index(m) for m in ROLLUP_METRICS)
+
+
+class TelemetryWriter:
+    # Le righe sono tuple nell'ordine di TELEMETRY_COLUMNS, con ts in epoch secondi
+    def __init__(self, pool: MySQLPool):
+        self.pool = pool
+        self.queue: "Queue[tuple]" = Queue(maxsize=TELEMETRY_QUEUE_MAX)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._spill_lock = threading.Lock()
+        self._replay_error = ""
+        self._stats = {
+            "enqueued": 0, "written": 0, "batches": 0, "errors": 0,
+            "dropped": 0, "spilled": 0, "replayed": 0,
+        }
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="telemetry-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def enqueue(self, row: tuple):
+        self.enqueue_many([row])
+
+    def enqueue_many(self, rows: list):
+        # Un solo timeout di back-pressure per batch: il resto va direttamente in overflow
+        self._stats["enqueued"] += len(rows)
+        for i, row in enumerate(rows):
+            try:
+                self.queue.put(row, timeout=TELEMETRY_ENQUEUE_TIMEOUT_SEC)
+            except Full:
+                self._overflow(rows[i:])
+                return
+
+    def _overflow(self, rows: list):
+        if TELEMETRY_OVERFLOW_POLICY == "spill":
+            self._spill(rows)
+            return
+        if TELEMETRY_OVERFLOW_POLICY == "drop_oldest":
+            for row in rows:
+                try:
+                    self.queue.get_nowait()
+                    self._stats["dropped"] += 1
+                except Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(row)
+                except Full:
+                    self._stats["dropped"] += 1
+            return
+        self._stats["dropped"] += len(rows)
+
+    def _spill(self, rows: list):
+        try:
+            with self._spill_lock, open(TELEMETRY_SPILL_PATH, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+            self._stats["spilled"] += len(rows)
+        except Exception as e:
+            self._stats["dropped"] += len(rows)
+            logger.error(f"Errore spill telemetria su disco: {e}")
+
+    def _write(self, rows: list):
+        sql = (f"INSERT INTO telemetry ({', '.join(TELEMETRY_COLUMNS)}) VALUES "
+               + ",".join([_TELEMETRY_ROW_SQL] * len(rows)))
+        params = []
+        for row in rows:
+            params.append(row[0])
+            params.append(row[1])
+            params.append(datetime.fromtimestamp(row[2]))
+            params.extend(row[3:])
+        with self.pool.connection() as conn:
+            # grezzi e rollup nella stessa transazione: un batch fallito non lascia conteggi parziali
+            conn.start_transaction()
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            write_rollups(cur, rows)
+            conn.commit()
+            cur.close()
+        self._stats["written"] += len(rows)
+        self._stats["batches"] += 1
+
+    def _flush(self, rows: list) -> bool:
+        try:
+            self._write(rows)
+            return True
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"Errore scrittura batch telemetria ({len(rows)} righe): {e}")
+            self._overflow(rows)
+            return False
+
+    def _replay_spill(self) -> bool:
+        # Lettura a blocchi di TELEMETRY_BATCH_SIZE righe: memoria limitata anche dopo un lungo
+        # fermo del DB. La posizione dopo l'ultimo batch committato va in <replay>.offset:
+        # dopo un errore, uno stop o un riavvio si riprende da lì senza riscrivere il file
+        replay_path = TELEMETRY_SPILL_PATH + ".replay"
+        offset_path = replay_path + ".offset"
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(TELEMETRY_SPILL_PATH):
+                    return True
+                os.replace(TELEMETRY_SPILL_PATH, replay_path)
+                logger.info(f"Replay telemetria da {replay_path}")
+
+        offset = 0
+        if os.path.exists(offset_path):
+            with open(offset_path, "r", encoding="utf-8") as f:
+                offset = int(f.read().strip() or 0)
+        with open(replay_path, "rb") as f:
+            f.seek(offset)
+            while True:
+                chunk = []
+                while len(chunk) < TELEMETRY_BATCH_SIZE:
+                    line = f.readline()
+                    if not line:
+                        break
+                    if not line.strip():
+                        continue
+                    try:
+                        chunk.append(tuple(json.loads(line)))
+                    except ValueError:
+                        self._stats["dropped"] += 1  # riga troncata (crash durante lo spill)
+                if not chunk:
+                    break
+                try:
+                    self._write(chunk)
+                except Exception as e:
+                    self._stats["errors"] += 1
+                    self._replay_error = f"byte {offset}: {e}"
+                    return False
+                offset = f.tell()
+                with open(offset_path + ".tmp", "w", encoding="utf-8") as out:
+                    out.write(str(offset))
+                os.replace(offset_path + ".tmp", offset_path)
+                self._stats["replayed"] += len(chunk)
+                if self._stop.is_set():
+                    return True
+        os.remove(replay_path)
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+        return True
+
+    def _run(self):
+        batch: list = []
+        next_flush = time.time() + TELEMETRY_FLUSH_INTERVAL_SEC
+        # Replay con backoff esponenziale: a DB giù un tentativo ogni tanto, non a ogni giro;
+        # nel log solo il primo errore e il ripristino
+        replay_delay, next_replay, replay_failing = 0.0, 0.0, False
+        while not (self._stop.is_set() and self.queue.empty() and not batch):
+            try:
+                batch.append(self.queue.get(timeout=max(0.0, next_flush - time.time())))
+                while len(batch) < TELEMETRY_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            if len(batch) < TELEMETRY_BATCH_SIZE and time.time() < next_flush and not self._stop.is_set():
+                continue
+
+            ok = True
+            if batch:
+                ok = self._flush(batch)
+                batch = []
+            next_flush = time.time() + TELEMETRY_FLUSH_INTERVAL_SEC
+
+            if not ok:
+                self._stop.wait(TELEMETRY_RETRY_BACKOFF_SEC)
+            elif self.queue.empty() and not self._stop.is_set() and time.time() >= next_replay:
+                try:
+                    replayed = self._replay_spill()
+                except Exception as e:
+                    self._replay_error = str(e)
+                    replayed = False
+                if replayed:
+                    if replay_failing:
+                        logger.info("Replay telemetria ripristinato")
+                    replay_delay, next_replay, replay_failing = 0.0, 0.0, False
+                else:
+                    if not replay_failing:
+                        logger.error(f"Replay telemetria interrotto ({self._replay_error}), "
+                                     f"nuovi tentativi con backoff")
+                    replay_failing = True
+                    replay_delay = min(TELEMETRY_REPLAY_BACKOFF_MAX_SEC,
+                                       max(TELEMETRY_RETRY_BACKOFF_SEC, replay_delay * 2))
+                    next_replay = time.time() + replay_delay
+
+    def stats(self) -> Dict[str, Any]:
+        out = dict(self._stats)
+        out["queued"] = self.queue.qsize()
+        return out
+
+
+# ---------------------------------------------------------------------------
+# ROLLUP TELEMETRIA (1 min / 15 min / 1 h)
+# ---------------------------------------------------------------------------
+
+_ROLLUP_COLUMNS = ["ugrid_id", "battery_index", "bucket_ts", "samples"] + [
+    f"{m}_{agg}" for m in ROLLUP_METRICS for agg in ("min", "max", "sum", "n")] + ["profit_eur"]
+
+def _rollup_upsert_sql(table: str, n_rows: int) -> str:
+    updates = ["samples = samples + VALUES(samples)"]
+    for m in ROLLUP_METRICS:
+        updates.append(f"{m}_min = LEAST(COALESCE({m}_min, VALUES({m}_min)), COALESCE(VALUES({m}_min), {m}_min))")
+        updates.append(f"{m}_max = GREATEST(COALESCE({m}_max, VALUES({m}_max)), COALESCE(VALUES({m}_max), {m}_max))")
+        updates.append(f"{m}_sum = COALESCE({m}_sum + VALUES({m}_sum), {m}_sum, VALUES({m}_sum))")
+        updates.append(f"{m}_n = {m}_n + VALUES({m}_n)")
+    updates.append("profit_eur = COALESCE(profit_eur + VALUES(profit_eur), profit_eur, VALUES(profit_eur))")
+    row_sql = "(" + ",".join(["%s"] * len(_ROLLUP_COLUMNS)) + ")"
+    return (f"INSERT INTO {table} ({', '.join(_ROLLUP_COLUMNS)}) VALUES "
+            + ",".join([row_sql] * n_rows)
+            + " ON DUPLICATE KEY UPDATE " + ", ".join(updates))
+
+def aggregate_rollup(rows: list, width: int) -> list:
+    # Pre-aggrega in Python le righe di un batch per (uGrid, batteria, bucket)
+    acc: Dict[Tuple[str, int, int], list] = {}
+    for row in rows:
+        key = (row[0], row[1], int(row[2] // width) * width)
+        a = acc.get(key)
+        if a is None:
+            a = acc[key] = [0] + [None, None, None, 0] * len(ROLLUP_METRICS) + [None]
+        a[0] += 1
+        for i, pos in enumerate(_ROLLUP_METRIC_POS):
+            v = row[pos]
+            if v is None:
+                continue
+            j = 1 + 4 * i
+            a[j] = v if a[j] is None else min(a[j], v)
+            a[j + 1] = v if a[j + 1] is None else max(a[j + 1], v)
+            a[j + 2] = v if a[j + 2] is None else a[j + 2] + v
+            a[j + 3] += 1
+        profit = row[-1]
+        if profit is not None:
+            a[-1] = profit if a[-1] is None else a[-1] + profit
+    return [(ug, idx, datetime.fromtimestamp(bucket), *a) for (ug, idx, bucket), a in acc.items()]
+
+def write_rollups(cur, rows: list):
+    for name, width, _ in ROLLUP_TIERS:
+        agg = aggregate_rollup(rows, width)
+        if not agg:
+            continue
+        cur.execute(_rollup_upsert_sql(f"telemetry_{name}", len(agg)),
+                    [v for r in agg for v in r])
+
+def purge_rollups():
+    with db_write_pool.connection() as conn:
+        cur = conn.cursor()
+        for name, _, retention_days in ROLLUP_TIERS:
+            cur.execute(f"DELETE FROM telemetry_{name} WHERE bucket_ts < NOW() - INTERVAL %s DAY",
+                        (retention_days,))
+            if cur.rowcount:
+                logger.info(f"Retention telemetry_{name}: eliminati {cur.rowcount} bucket")
+        cur.close()
+
+def plan_history_tier(start_ts: float, end_ts: float, step_sec: float,
+                      now: Optional[float] = None) -> Tuple[str, int]:
+    # Restituisce (tabella, ampiezza bucket); ampiezza 0 = telemetria grezza.
+    # Sceglie il tier più grossolano con bucket <= step che copre l'intervallo richiesto;
+    # se nessuno ha la risoluzione richiesta, il tier più fine che copre l'intervallo.
+    now = now or time.time()
+    covering = [(name, width) for name, width, days in ROLLUP_TIERS
+                if start_ts >= now - days * 86400]
+    fine_enough = [(name, width) for name, width in covering if width <= step_sec]
+    raw_covers = (TELEMETRY_SCHEMA_MODE != "timeseries"
+                  or start_ts >= now - TELEMETRY_RETENTION_DAYS * 86400)
+    if fine_enough:
+        name, width = max(fine_enough, key=lambda t: t[1])
+        return f"telemetry_{name}", width
+    if raw_covers or not covering:
+        return "telemetry", 0
+    name, width = min(covering, key=lambda t: t[1])
+    return f"telemetry_{name}", width
+
+
+# ---------------------------------------------------------------------------
+# SERIE STORICHE BUCKETIZZATE
+# ---------------------------------------------------------------------------
+
+HISTORY_AGGS = ("avg", "min", "max", "minmax", "lttb")
+
+def parse_time_arg(value: Optional[str], default: float) -> float:
+    # Accetta epoch in secondi o ISO 8601
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+def lttb_indices(xs: list, ys: list, threshold: int) -> list:
+    # Largest-Triangle-Three-Buckets: indici dei punti da mantenere
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    out = [0]
+    for i in range(threshold - 2):
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        span = max(avg_end - avg_start, 1)
+        avg_x = sum(xs[avg_start:avg_end]) / span
+        avg_y = sum(ys[avg_start:avg_end]) / span
+        best, best_area = int(i * every) + 1, -1.0
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        out.append(best)
+        a = best
+    out.append(n - 1)
+    return out
+
+def query_battery_series(conn, ugrid_id: str, battery_index: int, start_ts: float, end_ts: float,
+                         step: float, agg: str, points: int, lttb_field: str = "soc") -> Dict[str, Any]:
+    fetch_step = step / HISTORY_LTTB_OVERSAMPLE if agg == "lttb" else step
+    table, width = plan_history_tier(start_ts, end_ts, fetch_step)
+    if width:
+        # bucket multipli dell'ampiezza del tier
+        fetch_step = max(width, int(-(-fetch_step // width)) * width)
+        bucket_col, samples = "bucket_ts", "SUM(samples)"
+        metrics = [f"SUM({m}_sum)/NULLIF(SUM({m}_n), 0) AS {m}_avg, MIN({m}_min) AS {m}_min, "
+                   f"MAX({m}_max) AS {m}_max" for m in ROLLUP_METRICS]
+    else:
+        fetch_step = max(1, int(fetch_step))
+        bucket_col, samples = "ts", "COUNT(*)"
+        metrics = [f"AVG({m}) AS {m}_avg, MIN({m}) AS {m}_min, MAX({m}) AS {m}_max"
+                   for m in ROLLUP_METRICS]
+
+    cur = conn.cursor(dictionary=True)
+    cur.execute(f"""
+        SELECT FLOOR(UNIX_TIMESTAMP({bucket_col}) / %s) * %s AS bucket, {samples} AS samples,
+               {", ".join(metrics)}, SUM(profit_eur) AS profit_eur
+        FROM {table}
+        WHERE ugrid_id=%s AND battery_index=%s
+          AND {bucket_col} >= FROM_UNIXTIME(%s) AND {bucket_col} < FROM_UNIXTIME(%s)
+        GROUP BY bucket ORDER BY bucket
+    """, (fetch_step, fetch_step, ugrid_id, battery_index, start_ts, end_ts))
+    rows = cur.fetchall()
+    cur.close()
+
+    if agg == "lttb":
+        rows = [r for r in rows if r[f"{lttb_field}_avg"] is not None]
+        keep = lttb_indices([float(r["bucket"]) for r in rows],
+                            [float(r[f"{lttb_field}_avg"]) for r in rows], points)
+        rows = [rows[i] for i in keep]
+
+    out = []
+    for r in rows[:points]:
+        p = {"ts": datetime.fromtimestamp(float(r["bucket"])).isoformat(),
+             "samples": int(r["samples"]), "profit_eur": r["profit_eur"]}
+        for m in ROLLUP_METRICS:
+            if agg == "minmax":
+                p[f"{m}_min"] = r[f"{m}_min"]
+                p[f"{m}_max"] = r[f"{m}_max"]
+            else:
+                p[m] = r[f"{m}_{'avg' if agg == 'lttb' else agg}"]
+        out.append(p)
+
+    return {
+        "ugrid_id": ugrid_id, "battery_index": battery_index,
+        "from": datetime.fromtimestamp(start_ts).isoformat(),
+        "to": datetime.fromtimestamp(end_ts).isoformat(),
+        "step": step if agg == "lttb" else fetch_step, "agg": agg, "source": table,
+        "points": out,
+    }
+
+
 # ---------------------------------------------------------------------------
 # HELPERS COAP (CoAPthon3 implementation)
 # ---------------------------------------------------------------------------
@@ -162,58 +1088,308 @@ def _parse_coap_uri(uri: str) -> Tuple[str, int, str]:
         path = path[1:]
     return host, port, path
 
+class _PooledCoapClient:
+    def __init__(self, server: Tuple[str, int]):
+        self.server = server
+        self.client = HelperClient(server=server)
+        # HelperClient usa una sola coda di risposte: una richiesta alla volta
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self.failures = 0
+        self.requests = 0
+        self.stale = 0  # risposte di scambi precedenti scartate
+        self.cancelled = 0  # scambi abbandonati per timeout
+
+    def is_healthy(self) -> bool:
+        protocol = getattr(self.client, "protocol", None)
+        stopped = getattr(protocol, "stopped", None)
+        if stopped is not None and stopped.is_set():
+            return False
+        return self.failures < COAP_POOL_MAX_FAILURES
+
+    def drain(self):
+        # scarta eventuali risposte tardive di richieste andate in timeout
+        while True:
+            try:
+                self.client.queue.get_nowait()
+            except Empty:
+                break
+
+    def request(self, code, path: str, payload: Optional[bytes] = None, timeout: float = 5.0):
+        # Risposta abbinata per token: la coda è condivisa tra gli scambi, quindi risposte
+        # tardive a richieste andate in timeout e i None di rinuncia di CoAPthon per quelle
+        # richieste si scartano invece di essere consegnati alla richiesta corrente
+        request = self.client.mk_request(code, path)
+        request.token = generate_random_token(4)
+        if payload is not None:
+            request.payload = payload
+        self.client.protocol.send_message(request)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise Empty
+                response = self.client.queue.get(timeout=remaining)
+            except Empty:
+                self._cancel(request)
+                return None
+            if response is None:
+                if request.timeouted or self.client.protocol.stopped.is_set():
+                    return None  # rinuncia su questa richiesta o client chiuso
+            elif response.token == request.token:
+                return response
+            self.stale += 1
+
+    def _cancel(self, request):
+        # Il chiamante ha rinunciato: CoAPthon ritrasmetterebbe la CON fino a EXCHANGE_LIFETIME,
+        # e un setpoint vecchio potrebbe arrivare dopo uno più recente. Si ferma la ritrasmissione
+        # (rejected: niente None di rinuncia in coda) e si rimuove la transazione
+        request.rejected = True
+        layer = self.client.protocol._messageLayer
+        for table in (layer._transactions, layer._transactions_token):
+            for key, transaction in list(table.items()):
+                if transaction.request is request:
+                    table.pop(key, None)
+                    if transaction.retransmit_stop is not None:
+                        transaction.retransmit_stop.set()
+        self.cancelled += 1
+
+    def close(self):
+        try:
+            self.client.stop()
+        except Exception:
+            pass
+
+
+class CoapClientPool:
+    def __init__(self):
+        self._clients: Dict[Tuple[str, int], _PooledCoapClient] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        self.created = 0
+        self.evicted = 0
+
+    @contextmanager
+    def session(self, host: str, port: int):
+        self._maybe_sweep()
+        entry = self._get_entry((host, port))
+        with entry.lock:
+            if not entry.is_healthy():
+                entry = self._replace_entry(entry)
+            entry.drain()
+            try:
+                yield entry
+            except Exception:
+                entry.failures += 1
+                raise
+            else:
+                entry.failures = 0
+            finally:
+                entry.requests += 1
+                entry.last_used = time.time()
+
+    def _get_entry(self, key: Tuple[str, int]) -> _PooledCoapClient:
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None:
+                entry = _PooledCoapClient(key)
+                self._clients[key] = entry
+                self.created += 1
+            return entry
+
+    def _replace_entry(self, old: _PooledCoapClient) -> _PooledCoapClient:
+        # chiamato con old.lock acquisito: il nuovo client eredita il lock
+        logger.warning(f"Client CoAP {old.server} non sano, ricreazione")
+        old.close()
+        entry = _PooledCoapClient(old.server)
+        entry.lock = old.lock
+        with self._lock:
+            self._clients[old.server] = entry
+            self.created += 1
+        return entry
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < COAP_POOL_SWEEP_INTERVAL_SEC:
+            return
+        self._last_sweep = now
+        self.evict_idle(now)
+
+    def evict_idle(self, now: Optional[float] = None):
+        now = now or time.time()
+        with self._lock:
+            idle = [k for k, e in self._clients.items()
+                    if now - e.last_used > COAP_POOL_IDLE_TIMEOUT_SEC and not e.lock.locked()]
+            victims = [self._clients.pop(k) for k in idle]
+        for entry in victims:
+            entry.close()
+            self.evicted += 1
+        if victims:
+            logger.info(f"Pool CoAP: chiusi {len(victims)} client inattivi")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            clients = {f"{h}:{p}": {"requests": e.requests, "failures": e.failures, "stale": e.stale,
+                                    "cancelled": e.cancelled,
+                                    "idle_sec": round(time.time() - e.last_used, 1)}
+                       for (h, p), e in self._clients.items()}
+        return {"created": self.created, "evicted": self.evicted, "clients": clients}
+
+    def close_all(self):
+        with self._lock:
+            victims = list(self._clients.values())
+            self._clients.clear()
+        for entry in victims:
+            entry.close()
+
+
+coap_pool = CoapClientPool()
+
 def coap_get(uri: str, timeout: float = 5.0) -> Tuple[bytes, Optional[int]]:
     host, port, path = _parse_coap_uri(uri)
-    client = None
     try:
-        client = HelperClient(server=(host, port))
-        response = client.get(path, timeout=timeout)
-        
-        if response:
-            payload = response.payload
-            if isinstance(payload, str):
-                payload = payload.encode('utf-8')
-            
-            cf = response.content_type
-            return payload, cf
-        else:
-            raise IOError("Nessuna risposta dal server CoAP (timeout o errore)")
-            
+        with coap_pool.session(host, port) as session:
+            response = session.request(defines.Codes.GET, path, timeout=timeout)
+            if not response:
+                raise IOError("Nessuna risposta dal server CoAP (timeout o errore)")
+
+        payload = response.payload
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        cf = response.content_type
+        return payload, cf
+
     except Exception as e:
         logger.error(f"Errore coap_get su {uri}: {e}")
         raise e
-    finally:
-        if client:
-            client.stop()
 
 def coap_put(uri: str, payload: bytes, timeout: float = 5.0) -> bytes:
     host, port, path = _parse_coap_uri(uri)
-    client = None
     try:
-        client = HelperClient(server=(host, port))
-        response = client.put(path, payload, timeout=timeout)
-        
-        if response:
-            p_out = response.payload
-            if isinstance(p_out, str):
-                p_out = p_out.encode('utf-8')
-            return p_out
-        else:
-            raise IOError("Nessuna risposta dal server CoAP (timeout PUT)")
-            
+        with coap_pool.session(host, port) as session:
+            response = session.request(defines.Codes.PUT, path, payload, timeout=timeout)
+            if not response:
+                raise IOError("Nessuna risposta dal server CoAP (timeout PUT)")
+
+        p_out = response.payload
+        if isinstance(p_out, str):
+            p_out = p_out.encode('utf-8')
+        return p_out
+
     except Exception as e:
         logger.error(f"Errore coap_put su {uri}: {e}")
         raise e
-    finally:
-        if client:
-            client.stop()
+
+# ---------------------------------------------------------------------------
+# REGISTRO UGRID
+# ---------------------------------------------------------------------------
+
+class UgridRegistry:
+    # Copy-on-write come la cache obiettivi: all() restituisce un dict mai modificato in place
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ugrids: Dict[str, Dict[str, Any]] = {}
+
+    def all(self) -> Dict[str, Dict[str, Any]]:
+        return self._ugrids
+
+    def get(self, ugrid_id: str) -> Optional[Dict[str, Any]]:
+        return self._ugrids.get(ugrid_id)
+
+    def __contains__(self, ugrid_id) -> bool:
+        return ugrid_id in self._ugrids
+
+    def load(self):
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT ugrid_id, coap_state_uri, source FROM ugrids")
+            rows = cur.fetchall()
+            cur.close()
+        ugrids = {ug: {"coap_state_uri": uri, "source": source} for ug, uri, source in rows}
+        with self._lock:
+            added, removed = ugrids.keys() - self._ugrids.keys(), self._ugrids.keys() - ugrids.keys()
+            self._ugrids = ugrids
+        if added or removed:
+            logger.info(f"Registro uGrid: {len(ugrids)} uGrid (+{sorted(added)} -{sorted(removed)})")
+
+    def register(self, ugrid_id: str, coap_state_uri: str, source: str = "api") -> bool:
+        # False se l'URI è già registrato con un altro id
+        parsed = urlparse(coap_state_uri)
+        if parsed.scheme != "coap" or not parsed.hostname:
+            raise ValueError(f"URI CoAP non valido: {coap_state_uri}")
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT ugrid_id FROM ugrids WHERE coap_state_uri=%s", (coap_state_uri,))
+            row = cur.fetchone()
+            if row and row[0] != ugrid_id:
+                cur.close()
+                return False
+            cur.execute("""
+                INSERT INTO ugrids (ugrid_id, coap_state_uri, source) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE coap_state_uri=VALUES(coap_state_uri), source=VALUES(source)
+            """, (ugrid_id, coap_state_uri, source))
+            cur.close()
+        with self._lock:
+            ugrids = dict(self._ugrids)
+            ugrids[ugrid_id] = {"coap_state_uri": coap_state_uri, "source": source}
+            self._ugrids = ugrids
+        logger.info(f"uGrid {ugrid_id} registrata ({source}): {coap_state_uri}")
+        return True
+
+    def unregister(self, ugrid_id: str) -> bool:
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM ugrids WHERE ugrid_id=%s", (ugrid_id,))
+            found = cur.rowcount > 0
+            cur.close()
+        with self._lock:
+            ugrids = dict(self._ugrids)
+            ugrids.pop(ugrid_id, None)
+            self._ugrids = ugrids
+        if found:
+            logger.info(f"uGrid {ugrid_id} rimossa dal registro")
+        return found
+
+
+ugrid_registry = UgridRegistry()
+
+# Pagina del rpl-border-router Contiki-NG: "Routes" in storing mode (<li>addr/128 ...),
+# "Routing links" in non-storing / RPL-Lite, il default (<li>addr (parent: ...))
+_BR_ROUTE_RE = re.compile(r"<li>([0-9a-fA-F:]+)(?:/128| \(parent:)")
+
+
+def discover_ugrids() -> list:
+    # Nodi raggiungibili dal border router che espongono /dev/state: [(ugrid_id, uri)]
+    with urlopen(DISCOVERY_BORDER_ROUTER_URL, timeout=5.0) as resp:
+        page = resp.read().decode("utf-8", "replace")
+    found = []
+    for addr in sorted(set(_BR_ROUTE_RE.findall(page))):
+        try:
+            # forma compressa ("fd00::212:4b00:...") inclusa: i gruppi vanno espansi
+            iid = ipaddress.IPv6Address(addr).packed[8:].hex()
+        except ValueError:
+            continue
+        try:
+            payload, _ = coap_get(f"coap://[{addr}]/.well-known/core", timeout=DISCOVERY_COAP_TIMEOUT_SEC)
+        except Exception:
+            continue
+        if b"</dev/state>" not in (payload or b""):
+            continue
+        # id derivato dall'interface identifier: stabile tra riavvii del nodo
+        found.append((f"ug-{iid}", f"coap://[{addr}]/dev/state"))
+    return found
+
 
 # ---------------------------------------------------------------------------
 # HELPERS Logica uGrid
 # ---------------------------------------------------------------------------
 
 def ugrid_obj_uri(ugrid_id: str) -> str:
-    cfg = UGRIDS[ugrid_id]
+    cfg = ugrid_registry.get(ugrid_id)
+    if cfg is None:
+        raise KeyError(f"uGrid {ugrid_id} non registrata")
     state_uri = cfg["coap_state_uri"]
     host, port, _ = _parse_coap_uri(state_uri)
     
@@ -224,22 +1400,137 @@ def ugrid_obj_uri(ugrid_id: str) -> str:
         
     return f"coap://{host_str}:{port}/ctrl/obj"
 
-def send_ugrid_objective(ugrid_id: str, battery_index: int, power_kw: float):
+def send_ugrid_objective(ugrid_id: str, battery_index: int, power_kw: float, timeout: float = 5.0):
     uri = ugrid_obj_uri(ugrid_id)
     body = {"idx": battery_index, "power_kw": int(power_kw * 100), "clear": 0}
     payload = json.dumps(body).encode("utf-8")
-    coap_put(uri, payload)
+    coap_put(uri, payload, timeout=timeout)
 
-def clear_ugrid_objective(ugrid_id: str, battery_index: int):
+def clear_ugrid_objective(ugrid_id: str, battery_index: int, timeout: float = 5.0):
     uri = ugrid_obj_uri(ugrid_id)
     body = {"idx": battery_index, "power_kw": 0, "clear": 1}
     payload = json.dumps(body).encode("utf-8")
-    coap_put(uri, payload)
+    coap_put(uri, payload, timeout=timeout)
+
+# ---------------------------------------------------------------------------
+# DISPATCH OBIETTIVI
+# ---------------------------------------------------------------------------
+
+class ObjectiveDispatcher:
+    # Per batteria: ultimo comando confermato, una PUT in volo al massimo e il comando più
+    # recente arrivato nel frattempo (coalescenza: gli intermedi si scartano).
+    # submit() non blocca mai: il poll thread non attende la rete.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=OBJ_DISPATCH_WORKERS, thread_name_prefix="obj-put")
+        self._stop = threading.Event()
+        self._stats = {"submitted": 0, "skipped": 0, "coalesced": 0, "sent": 0, "acked": 0,
+                       "retries": 0, "failed": 0, "superseded": 0}
+
+    @staticmethod
+    def _unchanged(acked, cmd, now) -> bool:
+        if acked is None:
+            return False
+        (kind, power), acked_at = acked
+        if kind != cmd[0] or now - acked_at >= OBJ_REFRESH_SEC:
+            return False
+        return kind == "clear" or abs(power - cmd[1]) <= OBJ_DEADBAND_KW
+
+    def submit(self, ugrid_id: str, battery_index: int, power_kw: Optional[float] = None, clear: bool = False):
+        key = (ugrid_id, int(battery_index))
+        cmd = ("clear", 0.0) if clear else ("set", float(power_kw))
+        now = time.time()
+        with self._lock:
+            self._stats["submitted"] += 1
+            st = self._state.setdefault(key, {"acked": None, "inflight": False, "pending": None})
+            if st["inflight"]:
+                # Il comando più recente sostituisce quello in attesa; un set in retry
+                # viene abbandonato (vedi _put), quindi un clear non può essere scavalcato
+                if st["pending"] is not None:
+                    self._stats["coalesced"] += 1
+                st["pending"] = cmd
+                return
+            if self._unchanged(st["acked"], cmd, now):
+                self._stats["skipped"] += 1
+                return
+            st["inflight"] = True
+        self._executor.submit(self._dispatch, key, cmd)
+
+    def invalidate(self, ugrid_id: Optional[str] = None, battery_index: Optional[int] = None):
+        # Obiettivo cambiato altrove (API, altro worker): il prossimo comando va inviato comunque
+        with self._lock:
+            for key, st in self._state.items():
+                if ugrid_id is None or (key[0] == ugrid_id and key[1] == battery_index):
+                    st["acked"] = None
+
+    def _superseded(self, key) -> bool:
+        with self._lock:
+            return self._state[key]["pending"] is not None
+
+    def _put(self, key, cmd) -> Optional[bool]:
+        # None = abbandonata per un comando più recente (es. clear durante i retry di un set)
+        ugrid_id, battery_index = key
+        backoff = OBJ_RETRY_BACKOFF_SEC
+        for attempt in range(OBJ_MAX_RETRIES):
+            if attempt:
+                if self._superseded(key):
+                    return None
+                self._stats["retries"] += 1
+                if self._stop.wait(backoff):
+                    return False
+                backoff *= 2
+                if self._superseded(key):
+                    return None
+            try:
+                self._stats["sent"] += 1
+                if cmd[0] == "clear":
+                    clear_ugrid_objective(ugrid_id, battery_index, timeout=OBJ_PUT_TIMEOUT_SEC)
+                else:
+                    send_ugrid_objective(ugrid_id, battery_index, cmd[1], timeout=OBJ_PUT_TIMEOUT_SEC)
+                return True
+            except Exception as e:
+                logger.warning(f"PUT obiettivo {ugrid_id}/{battery_index} fallita "
+                               f"(tentativo {attempt + 1}/{OBJ_MAX_RETRIES}): {e}")
+        return False
+
+    def _dispatch(self, key, cmd):
+        while True:
+            ok = self._put(key, cmd)
+            now = time.time()
+            with self._lock:
+                st = self._state[key]
+                if ok:
+                    st["acked"] = (cmd, now)
+                    self._stats["acked"] += 1
+                elif ok is None:
+                    st["acked"] = None  # stato del dispositivo incerto
+                    self._stats["superseded"] += 1
+                else:
+                    self._stats["failed"] += 1  # acked invariato: il prossimo poll ritenta
+                cmd, st["pending"] = st["pending"], None
+                if cmd is None or self._stop.is_set() or self._unchanged(st["acked"], cmd, now):
+                    st["inflight"] = False
+                    return
+
+    def stop(self):
+        self._stop.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out["inflight"] = sum(1 for st in self._state.values() if st["inflight"])
+        return out
 
 # ---------------------------------------------------------------------------
 # DECODIFICA /dev/state (JSON o CBOR)
 # ---------------------------------------------------------------------------
 
+STATE_CODES = {0: "INI", 1: "RUN", 2: "ISO"}
+_STATE_CODE_OF = {v: k for k, v in STATE_CODES.items()}
+_STATE_NAMES = np.array([STATE_CODES[c] for c in range(len(STATE_CODES))], dtype=object)
+
 def _decode_state_from_cbor(obj: Any) -> Dict[str, Any]:
     if not isinstance(obj, dict):
         raise ValueError("CBOR root non è una mappa")
@@ -249,26 +1540,21 @@ def _decode_state_from_cbor(obj: Any) -> Dict[str, Any]:
     cnt = int(obj.get(0, 0))
     load_kw = (obj.get(1, 0) or 0) / 100.0
     pv_kw = (obj.get(2, 0) or 0) / 100.0
-    bats_raw = obj.get(3, []) or []
-    st_map = {0: "INI", 1: "RUN", 2: "ISO"}
-    bats: list[dict] = []
-    for entry in bats_raw:
-        if not isinstance(entry, (list, tuple)) or len(entry) < 9:
-            continue
-        idx, u_c, S_c, p_c, V_c, I_c, T_c, H_c, st = entry[:9]
-        bats.append({
-            "idx": int(idx),
-            "u": (u_c or 0) / 100.0,
-            "S": (S_c or 0) / 100.0,
-            "p": (p_c or 0) / 100.0,
-            "V": (V_c or 0) / 100.0,
-            "I": (I_c or 0) / 100.0,
-            "T": (T_c or 0) / 100.0,
-            "H": (H_c or 0) / 100.0,
-            "state": st_map.get(int(st), str(st)),
-        })
+    # Batterie decodificate direttamente in colonne, senza un dict per batteria:
+    # entry [idx, u, S, p, V, I, T, H, st] in centesimi, campi null = 0
+    entries = [e[:9] for e in obj.get(3, []) or [] if isinstance(e, (list, tuple)) and len(e) >= 9]
+    raw = np.array(entries, dtype=np.float64).reshape(len(entries), 9)
+    np.nan_to_num(raw, copy=False)
+    idx = raw[:, 0].astype(np.int64)
+    values = np.empty((len(entries), len(BATT_FIELDS)), dtype=np.float64)
+    values[:, _CBOR_BATT_ORDER] = raw[:, 1:8] / 100.0
+    codes = raw[:, 8].astype(np.int64)
+    states = _STATE_NAMES[np.clip(codes, 0, len(_STATE_NAMES) - 1)]
+    unknown = (codes < 0) | (codes >= len(_STATE_NAMES))
+    states[unknown] = codes[unknown].astype(str)
     return {
-        "cnt": cnt, "load_kw": load_kw, "pv_kw": pv_kw, "bats": bats,
+        "cnt": cnt, "load_kw": load_kw, "pv_kw": pv_kw,
+        "columns": (idx, values, states.tolist()),
     }
 
 def decode_ugrid_state(payload: bytes, content_format: Optional[int]) -> Dict[str, Any]:
@@ -289,11 +1575,210 @@ def decode_ugrid_state(payload: bytes, content_format: Optional[int]) -> Dict[st
                 pass
         raise ValueError("Impossibile decodificare stato (ne JSON ne CBOR valido)")
 
+# Campi batteria di /dev/state nell'ordine delle colonne telemetry da soc a optimal_u_kw
+BATT_FIELDS = ("S", "H", "V", "T", "I", "p", "u")
+BATT_SOC, BATT_SOH, BATT_V, BATT_T, BATT_I, BATT_P, BATT_U = range(len(BATT_FIELDS))
+_BATT_COL0 = _TELEMETRY_COL["soc"]
+BATT_FIELDS_COLUMNS = TELEMETRY_COLUMNS[_BATT_COL0:_BATT_COL0 + len(BATT_FIELDS)]
+
+def battery_columns(bats: list) -> Tuple[np.ndarray, np.ndarray]:
+    # Lista di batterie decodificata -> (indici, matrice n x BATT_FIELDS); campi mancanti = NaN
+    idx = np.fromiter((int(b.get("idx", 0)) for b in bats), dtype=np.int64, count=len(bats))
+    values = np.array([[b.get(k) for k in BATT_FIELDS] for b in bats], dtype=np.float64)
+    return idx, values.reshape(len(bats), len(BATT_FIELDS))
+
+def _nan_to_none(a: np.ndarray) -> np.ndarray:
+    out = a.astype(object)
+    out[np.isnan(a)] = None
+    return out
+
+# Ordine dei campi batteria nelle entry CBOR del firmware: [idx, u, S, p, V, I, T, H, st]
+_CBOR_BATT_ORDER = [BATT_U, BATT_SOC, BATT_P, BATT_V, BATT_I, BATT_T, BATT_SOH]
+
+def encode_ugrid_state_cbor(idx: np.ndarray, values: np.ndarray, states: list,
+                            load_kw, pv_kw, ts: float) -> bytes:
+    # Inverso di _decode_state_from_cbor (centesimi interi); chiave 4 = timestamp epoch RCA,
+    # ignorata dal decoder. Campi mancanti = null.
+    n = len(idx)
+    cents = np.rint(values[:, _CBOR_BATT_ORDER] * 100.0)
+    missing = np.isnan(cents)
+    table = np.empty((n, 9), dtype=object)
+    table[:, 0] = idx
+    table[:, 1:8] = np.where(missing, 0, cents).astype(np.int64)
+    table[:, 1:8][missing] = None
+    table[:, 8] = [_STATE_CODE_OF.get(st, 0) for st in states]
+    return cbor2.dumps({
+        0: n,
+        1: None if load_kw is None else int(round(load_kw * 100)),
+        2: None if pv_kw is None else int(round(pv_kw * 100)),
+        3: table.tolist(),
+        4: int(ts),
+    })
+
+# ---------------------------------------------------------------------------
+# OBSERVE /dev/state
+# ---------------------------------------------------------------------------
+
+class UgridObserver:
+    def __init__(self, ugrid_id: str, uri: str, sink):
+        self.ugrid_id = ugrid_id
+        self.uri = uri
+        self.sink = sink
+        self.client: Optional[HelperClient] = None
+        self.last_response = None
+        self.registered_at = 0.0
+        self.last_notification = 0.0
+        self.rejected = False
+        self.failures = 0
+        self.fallback_until = 0.0
+        self.notifications = 0
+
+    def is_active(self, now: float) -> bool:
+        if self.client is None or self.rejected:
+            return False
+        last = max(self.registered_at, self.last_notification)
+        return now - last <= OBSERVE_MAX_SILENCE_SEC
+
+    def register(self):
+        self.cancel()
+        host, port, path = _parse_coap_uri(self.uri)
+        self.rejected = False
+        self.registered_at = time.time()
+        self.client = HelperClient(server=(host, port))
+        self.client.observe(path, self._on_notification)
+        logger.info(f"Observe registrato su {self.ugrid_id} ({self.uri})")
+
+    def cancel(self):
+        client, self.client = self.client, None
+        if client is None:
+            return
+        try:
+            if self.last_response is not None:
+                client.cancel_observing(self.last_response, True)
+        except Exception:
+            pass
+        try:
+            client.stop()
+        except Exception:
+            pass
+        self.last_response = None
+
+    def _on_notification(self, response):
+        # Chiamato dal thread di ricezione CoAPthon
+        if response is None or response.payload is None:
+            return
+        self.last_response = response
+        if response.observe is None:
+            # il server ha risposto ma non ha accettato l'osservazione
+            self.rejected = True
+        payload = response.payload
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        try:
+            state = decode_ugrid_state(payload, response.content_type)
+        except Exception as e:
+            logger.error(f"Notifica observe non valida da {self.ugrid_id}: {e}")
+            return
+        now = time.time()
+        self.last_notification = now
+        self.notifications += 1
+        if not self.rejected:
+            self.failures = 0
+        self.sink((self.ugrid_id, state, now))
+
+    def supervise(self, now: float):
+        if now < self.fallback_until or self.is_active(now):
+            return
+        if self.rejected:
+            self.failures = OBSERVE_MAX_FAILURES
+        elif self.client is not None:
+            self.failures += 1
+            logger.warning(f"Observe {self.ugrid_id}: nessuna notifica da "
+                           f"{now - max(self.registered_at, self.last_notification):.0f}s")
+
+        if self.failures >= OBSERVE_MAX_FAILURES:
+            logger.warning(f"Observe {self.ugrid_id} non disponibile, fallback a polling "
+                           f"per {OBSERVE_RETRY_SEC:.0f}s")
+            self.cancel()
+            self.failures = 0
+            self.fallback_until = now + OBSERVE_RETRY_SEC
+            return
+
+        try:
+            self.register()
+        except Exception as e:
+            self.failures += 1
+            self.cancel()
+            logger.error(f"Errore registrazione observe su {self.ugrid_id}: {e}")
+
+# ---------------------------------------------------------------------------
+# SCHEDULER POLL
+# ---------------------------------------------------------------------------
+
+class PollScheduler:
+    # Coda di priorità delle prossime scadenze per uGrid. Usato solo dal poll thread.
+    def __init__(self):
+        self._heap: list = []             # (due, ugrid_id)
+        self._due: Dict[str, float] = {}  # scadenza valida per uGrid (le altre voci nel heap sono obsolete)
+        self.failures: Dict[str, int] = {}
+        self.intervals: Dict[str, float] = {}
+
+    def _push(self, ugrid_id, due):
+        self._due[ugrid_id] = due
+        heapq.heappush(self._heap, (due, ugrid_id))
+
+    def sync(self, ugrid_ids, now: float):
+        # Nuove uGrid con fase casuale nell'intervallo base: niente raffiche sincronizzate
+        for ugrid_id in ugrid_ids:
+            if ugrid_id not in self._due:
+                self._push(ugrid_id, now + random.uniform(0.0, POLL_INTERVAL_SEC))
+        for ugrid_id in (set(self._due) | set(self.intervals)) - set(ugrid_ids):
+            self._due.pop(ugrid_id, None)
+            self.failures.pop(ugrid_id, None)
+            self.intervals.pop(ugrid_id, None)
+
+    def next_due(self) -> Optional[float]:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> list:
+        due = []
+        while True:
+            t = self.next_due()
+            if t is None or t > now:
+                return due
+            _, ugrid_id = heapq.heappop(self._heap)
+            del self._due[ugrid_id]
+            due.append(ugrid_id)
+
+    def schedule(self, ugrid_id, now: float, interval: float):
+        # Backoff esponenziale sui fallimenti consecutivi, con jitter
+        fails = self.failures.get(ugrid_id, 0)
+        if fails:
+            interval = min(interval * (2 ** fails), POLL_BACKOFF_MAX_SEC)
+        self.intervals[ugrid_id] = interval
+        self._push(ugrid_id, now + interval * random.uniform(1.0 - POLL_JITTER_FRAC, 1.0 + POLL_JITTER_FRAC))
+
+    def record(self, ugrid_id, ok: bool):
+        if ok:
+            self.failures.pop(ugrid_id, None)
+        elif ugrid_id in self.intervals:
+            self.failures[ugrid_id] = self.failures.get(ugrid_id, 0) + 1
+
+    def stats(self):
+        return {ug: {"interval_sec": round(iv, 2), "failures": self.failures.get(ug, 0)}
+                for ug, iv in sorted(dict(self.intervals).items())}
+
+
 # ---------------------------------------------------------------------------
 # MQTT 
 # ---------------------------------------------------------------------------
 
 class MqttPublisher:
+    # publish_alert() accoda e ritorna subito; un thread accorpa per topic (payload = lista
+    # se più messaggi) e pubblica. Senza broker i batch finiscono nello spool su disco,
+    # ripubblicato alla riconnessione; i batch QoS 1 non confermati allo stop vanno nello spool.
     def __init__(self, host: str, port: int):
         self.host = host
         self.port = port
@@ -301,15 +1786,38 @@ class MqttPublisher:
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self._connected = False
+        self.queue: "Queue[tuple]" = Queue(maxsize=MQTT_QUEUE_MAX)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._spool_lock = threading.Lock()
+        self._ack_lock = threading.Lock()
+        # mid -> (MQTTMessageInfo, topic, batch) in attesa di PUBACK; solo batch alert QoS > 0.
+        # Lo stato di conferma si legge da info.is_published(): nessuna ambiguità sui mid
+        # riusati da paho (snapshot QoS 0 compresi)
+        self._pending: Dict[int, Tuple[Any, str, list]] = {}
+        self._snapshots: Dict[str, bytes] = {}  # topic -> ultimo payload retained da pubblicare
+        self._stats = {"enqueued": 0, "published": 0, "batches": 0, "spooled": 0, "replayed": 0,
+                       "errors": 0, "snapshots": 0}
 
     def start(self):
+        self._stop.clear()
         try:
-            self.client.connect(self.host, self.port, keepalive=60)
+            self.client.connect_async(self.host, self.port, keepalive=60)
             self.client.loop_start()
         except Exception as e:
             logger.error(f"Errore connessione MQTT broker: {e}")
-
-    def stop(self):
+        self._thread = threading.Thread(target=self._run, name="mqtt-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._ack_lock:
+            unacked, self._pending = list(self._pending.values()), {}
+        for info, topic, msgs in unacked:
+            if not info.is_published():
+                self._spool(topic, msgs)
         try:
             self.client.loop_stop()
             self.client.disconnect()
@@ -327,159 +1835,1120 @@ class MqttPublisher:
         self._connected = False
         logger.warning("Disconnesso dal broker MQTT")
 
-    def publish_alert(self, level, ugrid_id, battery_index, message, payload):
+    def publish_alert(self, level, ugrid_id, battery_index, message, payload, event=None):
         topic_parts = [MQTT_ALERT_TOPIC_BASE, level, ugrid_id]
         if battery_index is not None:
             topic_parts.append(str(battery_index))
-        topic = "/".join(topic_parts)
         msg = {
             "level": level, "ugrid_id": ugrid_id, "battery_index": battery_index,
             "message": message, "timestamp": datetime.utcnow().isoformat() + "Z",
         }
         if payload: msg["data"] = payload
-        data_json = json.dumps(msg)
-        logger.info(f"[ALERT MQTT] {topic} -> {data_json}")
+        if event: msg["event"] = event
+        self.publish("/".join(topic_parts), msg)
+
+    def publish_snapshot(self, topic: str, payload):  # bytes o callable che li produce
+        # Conflazione: resta solo l'ultimo snapshot per topic, anche mentre il broker è giù
+        with self._ack_lock:
+            fresh = topic not in self._snapshots
+            self._snapshots[topic] = payload
+        if fresh:
+            try:
+                self.queue.put_nowait(None)  # sveglia il thread
+            except Full:
+                pass
+
+    def _send_snapshots(self):
+        if not self._connected:
+            return
+        with self._ack_lock:
+            snapshots, self._snapshots = self._snapshots, {}
+        for topic, payload in snapshots.items():
+            if callable(payload):
+                # codifica rinviata a qui: solo gli snapshot davvero pubblicati, fuori dal poll thread
+                try:
+                    payload = payload()
+                except Exception as e:
+                    self._stats["errors"] += 1
+                    logger.error(f"Errore codifica snapshot MQTT {topic}: {e}")
+                    continue
+            try:
+                info = self.client.publish(topic, payload=payload, qos=MQTT_TELEMETRY_QOS, retain=True)
+                ok = info.rc == mqtt.MQTT_ERR_SUCCESS
+            except Exception:
+                ok = False
+            if ok:
+                self._stats["snapshots"] += 1
+            else:
+                with self._ack_lock:
+                    self._snapshots.setdefault(topic, payload)  # riprova, salvo snapshot più recente
+
+    def publish(self, topic: str, msg: Dict[str, Any]):
+        self._stats["enqueued"] += 1
         try:
-            self.client.publish(topic, payload=data_json, qos=0)
+            self.queue.put_nowait((topic, msg))
+        except Full:
+            self._spool(topic, [msg])
+
+    def _send(self, topic: str, msgs: list) -> bool:
+        if not self._connected:
+            return False
+        body = json.dumps(msgs[0] if len(msgs) == 1 else msgs, default=str)
+        try:
+            info = self.client.publish(topic, payload=body, qos=MQTT_QOS)
         except Exception as e:
-            logger.error(f"Errore pubblicando alert MQTT: {e}")
+            logger.error(f"Errore pubblicando su MQTT {topic}: {e}")
+            return False
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        if MQTT_QOS > 0 and not info.is_published():
+            with self._ack_lock:
+                self._prune_acked()
+                stale = self._pending.get(info.mid)
+                self._pending[info.mid] = (info, topic, msgs)
+            if stale is not None:
+                self._spool(stale[1], stale[2])  # mid riusato prima del PUBACK: non si perde
+        logger.debug(f"[MQTT] {topic} <- {len(msgs)} messaggi")
+        self._stats["published"] += len(msgs)
+        self._stats["batches"] += 1
+        return True
+
+    def _prune_acked(self):
+        # Da chiamare con _ack_lock acquisito
+        for mid in [m for m, (info, _, _) in self._pending.items() if info.is_published()]:
+            del self._pending[mid]
+
+    def _spool(self, topic: str, msgs: list):
+        try:
+            with self._spool_lock, open(MQTT_SPOOL_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"topic": topic, "msgs": msgs}, default=str) + "\n")
+            self._stats["spooled"] += len(msgs)
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"Errore spool MQTT su disco, {len(msgs)} messaggi persi: {e}")
+
+    def _replay_spool(self):
+        # Al massimo MQTT_SPOOL_REPLAY_BATCH voci per chiamata, e solo con i PUBACK precedenti
+        # arrivati: niente raffica sul broker appena tornato e il traffico live si intercala.
+        # Posizione in <replay>.offset come per lo spill telemetria
+        replay_path = MQTT_SPOOL_PATH + ".replay"
+        offset_path = replay_path + ".offset"
+        with self._ack_lock:
+            self._prune_acked()
+            if len(self._pending) >= MQTT_SPOOL_REPLAY_BATCH:
+                return
+        with self._spool_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(MQTT_SPOOL_PATH):
+                    return
+                os.replace(MQTT_SPOOL_PATH, replay_path)
+
+        offset = 0
+        if os.path.exists(offset_path):
+            with open(offset_path, "r", encoding="utf-8") as f:
+                offset = int(f.read().strip() or 0)
+        if offset == 0:
+            logger.info(f"Replay spool MQTT da {replay_path}")
+        with open(replay_path, "rb") as f:
+            f.seek(offset)
+            sent = 0
+            while sent < MQTT_SPOOL_REPLAY_BATCH:
+                line = f.readline()
+                if not line:
+                    break
+                if line.strip():
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        self._stats["errors"] += 1  # riga troncata (crash durante lo spool)
+                        entry = None
+                    if entry is not None:
+                        if not self._send(entry["topic"], entry["msgs"]):
+                            break  # si riprende da offset al prossimo giro
+                        self._stats["replayed"] += len(entry["msgs"])
+                        sent += 1
+                offset = f.tell()
+            done = offset >= os.fstat(f.fileno()).st_size
+        if not done:
+            with open(offset_path + ".tmp", "w", encoding="utf-8") as out:
+                out.write(str(offset))
+            os.replace(offset_path + ".tmp", offset_path)
+            return
+        os.remove(replay_path)
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+        logger.info("Replay spool MQTT completato")
+
+    def _run(self):
+        while not (self._stop.is_set() and self.queue.empty()):
+            self._send_snapshots()
+            with self._ack_lock:
+                self._prune_acked()
+            try:
+                first = self.queue.get(timeout=1.0)
+            except Empty:
+                if self._connected and not self._stop.is_set():
+                    try:
+                        self._replay_spool()
+                    except Exception as e:
+                        logger.error(f"Errore replay spool MQTT: {e}")
+                continue
+
+            if first is None:
+                continue  # snapshot telemetria in attesa
+
+            # Finestra di accorpamento: una raffica di alert diventa un messaggio per topic
+            batch = [first]
+            deadline = time.time() + (0 if self._stop.is_set() else MQTT_BATCH_WINDOW_SEC)
+            while len(batch) < MQTT_BATCH_MAX * 4:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.time())))
+                except Empty:
+                    break
+            by_topic: Dict[str, list] = {}
+            for topic, msg in filter(None, batch):
+                by_topic.setdefault(topic, []).append(msg)
+            for topic, msgs in by_topic.items():
+                for i in range(0, len(msgs), MQTT_BATCH_MAX):
+                    chunk = msgs[i:i + MQTT_BATCH_MAX]
+                    if not self._send(topic, chunk):
+                        self._spool(topic, chunk)
+
+    def stats(self) -> Dict[str, Any]:
+        out = dict(self._stats)
+        out["queued"] = self.queue.qsize()
+        with self._ack_lock:
+            self._prune_acked()
+            out["pending_acks"] = len(self._pending)
+        out["connected"] = self._connected
+        return out
+
+# ---------------------------------------------------------------------------
+# ALERT ENGINE
+# ---------------------------------------------------------------------------
+
+def compile_alert_rules(rows: list) -> list:
+    # Righe di alert_rules -> una regola per rule_id con le soglie per scope
+    # (uGrid '', batteria -1 = tutte). Definizione (campo, operatore, livello, messaggio)
+    # dalla riga più generica.
+    by_rule: Dict[str, list] = {}
+    for r in rows:
+        by_rule.setdefault(r["rule_id"], []).append(r)
+    rules = []
+    for rule_id, group in sorted(by_rule.items()):
+        group.sort(key=lambda r: (r["ugrid_id"] != "", r["battery_index"] != -1))
+        base = group[0]
+        if base["field"] not in BATT_FIELDS_COLUMNS or base["op"] not in "<>":
+            logger.error(f"Regola alert {rule_id} non valida, ignorata")
+            continue
+        rules.append({
+            "rule_id": rule_id, "level": base["level"], "field": base["field"],
+            "col": BATT_FIELDS_COLUMNS.index(base["field"]), "op": base["op"],
+            "rate": base["kind"] == "rate", "message": base["message"],
+            "payload_key": base["field"] + ("_per_min" if base["kind"] == "rate" else ""),
+            "scopes": {(r["ugrid_id"], int(r["battery_index"])):
+                       (float(r["enter_value"]), float(r["exit_value"]), bool(r["enabled"])) for r in group},
+            # soglie per (uGrid, indici batterie): calcolate una volta per composizione
+            "cache": {},
+        })
+    return rules
+
+
+class AlertEngine:
+    # Stato per (uGrid, regola, batteria): un incidente genera un "raised", eventuali
+    # promemoria "still_active" e un "resolved"; i campioni intermedi aggiornano solo contatori.
+    # evaluate() è usato solo dal poll thread; reload() sostituisce le regole in blocco.
+    def __init__(self, publisher: MqttPublisher):
+        self.publisher = publisher
+        self.rules: list = []
+        self._prev: Dict[str, Tuple[np.ndarray, np.ndarray, float]] = {}  # per le regole "rate"
+        self.active: Dict[Tuple[str, str], Dict[int, Dict[str, Any]]] = {}   # (ug, rule) -> idx -> incidente
+        self.resolved: Dict[Tuple[str, str, int], Dict[str, Any]] = {}       # per il cooldown
+        self._checked_rules: Optional[list] = None  # regole per cui gli orfani sono già chiusi
+        self._stats = {"raised": 0, "reopened": 0, "reminded": 0, "resolved": 0, "notified": 0}
+
+    def reload(self):
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor(dictionary=True)
+            cur.execute("SELECT * FROM alert_rules")
+            rows = cur.fetchall()
+            cur.close()
+        rules = compile_alert_rules(rows)
+        self.rules = rules  # gli incidenti di regole rimosse li chiude evaluate() (poll thread)
+        logger.info(f"Regole alert caricate: {len(rules)} regole, {len(rows)} righe")
+
+    def _close_orphans(self, rules, now):
+        # Incidenti aperti di regole cancellate o disattivate ovunque: nessun campione li
+        # chiuderebbe più, quindi si risolvono al cambio regole
+        live = {r["rule_id"] for r in rules if any(en for _, _, en in r["scopes"].values())}
+        for (ugrid_id, rule_id) in [k for k in self.active if k[1] not in live]:
+            for battery_index, inc in self.active.pop((ugrid_id, rule_id)).items():
+                self._db_update(inc["id"], inc["count"], now, "resolved")
+                self.publisher.publish_alert(inc["level"], ugrid_id, battery_index,
+                                             f"Regola {rule_id} rimossa: incidente chiuso",
+                                             {"rule": rule_id, "alert_id": inc["id"],
+                                              "occurrences": inc["count"]}, event="resolved")
+                self._stats["resolved"] += 1
+        for key in [k for k in self.resolved if k[1] not in live]:
+            del self.resolved[key]
+        self._checked_rules = rules
+
+    def _rule_thresholds(self, rule, ugrid_id, idx: np.ndarray):
+        cache = rule["cache"]
+        key = (ugrid_id, idx.tobytes())
+        out = cache.get(key)
+        if out is None:
+            scopes = rule["scopes"]
+            base = scopes.get((ugrid_id, -1)) or scopes.get(("", -1)) or (np.nan, np.nan, False)
+            per_batt = [scopes.get((ugrid_id, i)) or scopes.get(("", i)) or base for i in idx.tolist()]
+            enter, exit_, enabled = zip(*per_batt) if per_batt else ((), (), ())
+            out = cache[key] = (np.array(enter, dtype=np.float64), np.array(exit_, dtype=np.float64),
+                                np.array(enabled, dtype=bool))
+        return out
+
+    def _rates(self, ugrid_id, idx, values, now) -> np.ndarray:
+        # Derivata al minuto rispetto al campione precedente della stessa batteria (NaN se assente)
+        prev = self._prev.get(ugrid_id)
+        self._prev[ugrid_id] = (idx, values, now)
+        rates = np.full(values.shape, np.nan)
+        if prev is None or now <= prev[2]:
+            return rates
+        prev_idx, prev_values, prev_ts = prev
+        if np.array_equal(prev_idx, idx):
+            aligned = prev_values
+        else:
+            pos = {int(v): p for p, v in enumerate(prev_idx.tolist())}
+            aligned = np.full(values.shape, np.nan)
+            for p, i in enumerate(idx.tolist()):
+                if i in pos:
+                    aligned[p] = prev_values[pos[i]]
+        return (values - aligned) * (60.0 / (now - prev_ts))
+
+    def load_active(self):
+        # Dopo un riavvio gli incidenti aperti proseguono invece di essere rinotificati
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT id, level, ugrid_id, battery_index, rule_id, occurrences,
+                       UNIX_TIMESTAMP(COALESCE(last_ts, ts))
+                FROM alerts WHERE state='active' AND rule_id IS NOT NULL
+            """)
+            rows = cur.fetchall()
+            cur.close()
+        self.active.clear()
+        for alert_id, level, ugrid_id, idx, rule_id, count, last in rows:
+            self.active.setdefault((ugrid_id, rule_id), {})[int(idx)] = {
+                "id": alert_id, "level": level, "count": int(count), "notified": float(last),
+                "value": None,
+            }
+        logger.info(f"Alert engine: {len(rows)} incidenti attivi ripristinati")
+
+    def evaluate(self, ugrid_id: str, idx: np.ndarray, values: np.ndarray, now: float):
+        rules = self.rules
+        if rules is not self._checked_rules:
+            self._close_orphans(rules, now)
+        rates = self._rates(ugrid_id, idx, values, now) if any(r["rate"] for r in rules) else None
+        for rule in rules:
+            col = (rates if rule["rate"] else values)[:, rule["col"]]
+            enter, exit_, enabled = self._rule_thresholds(rule, ugrid_id, idx)
+            if rule["op"] == "<":
+                entering, clearing = col < enter, col >= exit_
+            else:
+                entering, clearing = col > enter, col <= exit_
+            # regola disattivata per una batteria: non apre e chiude gli incidenti aperti
+            entering &= enabled
+            clearing |= ~enabled
+            incidents = self.active.setdefault((ugrid_id, rule["rule_id"]), {})
+            if not incidents and not entering.any():
+                continue
+
+            # NaN: né entra né esce, l'incidente resta nello stato corrente
+            pos = {int(v): p for p, v in enumerate(idx.tolist())}
+            for battery_index in list(incidents):
+                p = pos.get(battery_index)
+                if p is None:
+                    continue
+                inc = incidents[battery_index]
+                if clearing[p]:
+                    self._resolve(ugrid_id, rule, battery_index, incidents.pop(battery_index), float(col[p]), now)
+                    continue
+                inc["count"] += 1
+                if not np.isnan(col[p]):
+                    inc["value"] = float(col[p])
+                if now - inc["notified"] >= ALERT_REMINDER_SEC:
+                    self._remind(ugrid_id, rule, battery_index, inc, now)
+
+            for p in np.flatnonzero(entering):
+                battery_index = int(idx[p])
+                if battery_index not in incidents:
+                    incidents[battery_index] = self._raise(ugrid_id, rule, battery_index, float(col[p]), now)
+
+    def _raise(self, ugrid_id, rule, battery_index, value, now):
+        message = rule["message"].format(value=value)
+        payload = {rule["payload_key"]: value, "rule": rule["rule_id"]}
+        prev = self.resolved.pop((ugrid_id, rule["rule_id"], battery_index), None)
+        if prev is not None and now - prev["resolved_at"] < ALERT_COOLDOWN_SEC:
+            # flapping: riapre l'incidente appena chiuso (stessa riga, niente nuovo "raised");
+            # il "resolved" è già uscito, quindi i subscriber ricevono un "reopened"
+            inc = dict(prev, count=prev["count"] + 1, value=value, notified=now)
+            inc.pop("resolved_at", None)
+            self._db_update(inc["id"], inc["count"], now, "active")
+            self.publisher.publish_alert(inc["level"], ugrid_id, battery_index, f"Riaperto: {message}",
+                                         dict(payload, alert_id=inc["id"], occurrences=inc["count"]),
+                                         event="reopened")
+            self._stats["reopened"] += 1
+            return inc
+
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO alerts (level, ugrid_id, battery_index, message, payload,
+                                    rule_id, state, occurrences, last_ts)
+                VALUES (%s,%s,%s,%s,%s,%s,'active',1,FROM_UNIXTIME(%s))
+            """, (rule["level"], ugrid_id, battery_index, message, json.dumps(payload),
+                  rule["rule_id"], now))
+            alert_id = cur.lastrowid
+            cur.close()
+        self.publisher.publish_alert(rule["level"], ugrid_id, battery_index, message,
+                                     dict(payload, alert_id=alert_id), event="raised")
+        self._stats["raised"] += 1
+        return {"id": alert_id, "level": rule["level"], "count": 1, "notified": now, "value": value}
+
+    def _remind(self, ugrid_id, rule, battery_index, inc, now):
+        inc["notified"] = now
+        self._db_update(inc["id"], inc["count"], now, "active")
+        value = inc["value"]
+        message = (rule["message"].format(value=value) if value is not None else rule["rule_id"]) \
+            + f" (ancora attivo, {inc['count']} campioni)"
+        self.publisher.publish_alert(inc["level"], ugrid_id, battery_index, message,
+                                     {"rule": rule["rule_id"], "alert_id": inc["id"],
+                                      "occurrences": inc["count"]}, event="still_active")
+        self._stats["reminded"] += 1
+
+    def _resolve(self, ugrid_id, rule, battery_index, inc, value, now):
+        self._db_update(inc["id"], inc["count"], now, "resolved")
+        self.resolved[(ugrid_id, rule["rule_id"], battery_index)] = dict(inc, resolved_at=now)
+        message = f"Rientrato: {rule['message'].format(value=value)}"
+        self.publisher.publish_alert(inc["level"], ugrid_id, battery_index, message,
+                                     {rule["payload_key"]: value, "rule": rule["rule_id"], "alert_id": inc["id"],
+                                      "occurrences": inc["count"]}, event="resolved")
+        self._stats["resolved"] += 1
+
+    def notify(self, level, ugrid_id, battery_index, message, payload, now=None):
+        # Evento puntuale (es. obiettivo completato): nasce e si chiude subito, quindi la riga
+        # è già 'resolved' e compare in /api/alerts?state=resolved
+        now = now or time.time()
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO alerts (level, ugrid_id, battery_index, message, payload,
+                                    state, occurrences, last_ts, resolved_at)
+                VALUES (%s,%s,%s,%s,%s,'resolved',1,FROM_UNIXTIME(%s),FROM_UNIXTIME(%s))
+            """, (level, ugrid_id, battery_index, message, json.dumps(payload) if payload else None,
+                  now, now))
+            alert_id = cur.lastrowid
+            cur.close()
+        self.publisher.publish_alert(level, ugrid_id, battery_index, message,
+                                     dict(payload or {}, alert_id=alert_id), event="notice")
+        self._stats["notified"] += 1
+
+    def _db_update(self, alert_id, count, now, state):
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE alerts SET occurrences=%s, last_ts=FROM_UNIXTIME(%s), state=%s,
+                       resolved_at=IF(%s='resolved', FROM_UNIXTIME(%s), NULL)
+                WHERE id=%s
+            """, (count, now, state, state, now, alert_id))
+            cur.close()
+
+    def stats(self):
+        out = dict(self._stats)
+        out["active"] = sum(len(v) for v in list(self.active.values()))
+        return out
+
+
+# ---------------------------------------------------------------------------
+# EVENTI LIVE (SSE)
+# ---------------------------------------------------------------------------
+
+class StatusEventBroker:
+    # Ogni evento viene serializzato una sola volta e condiviso da tutti i client.
+    # Id SSE "<epoca>:<n>": il contatore è del processo, l'epoca distingue riavvii e worker
+    # (un Last-Event-ID di un'altra epoca riparte da uno snapshot)
+    def __init__(self, history: int = SSE_HISTORY_SIZE):
+        self._cond = threading.Condition()
+        self._events: deque = deque(maxlen=history)  # (id, frame)
+        self.last_id = 0
+        self.subscribers = 0
+        self.new_epoch()
+
+    def new_epoch(self):
+        # Da richiamare anche dopo il fork dei worker gunicorn
+        with self._cond:
+            self.epoch = f"{os.getpid():x}{int(time.time() * 1000):x}"
+            self._events.clear()
+            self.last_id = 0
+
+    def event_id(self, n: int) -> str:
+        return f"{self.epoch}:{n}"
+
+    def parse_event_id(self, value: Optional[str]) -> Optional[int]:
+        # None se assente, malformato o di un'altra epoca
+        epoch, _, n = (value or "").partition(":")
+        if epoch != self.epoch or not n.isdigit():
+            return None
+        return int(n)
+
+    def publish(self, event: str, data: Dict[str, Any]) -> int:
+        body = json.dumps(data, separators=(",", ":"), default=str)
+        with self._cond:
+            self.last_id += 1
+            self._events.append((self.last_id, f"id: {self.event_id(self.last_id)}\nevent: {event}\n"
+                                               f"data: {body}\n\n"))
+            self._cond.notify_all()
+            return self.last_id
+
+    def wait(self, after_id: int, timeout: float) -> Tuple[Optional[list], int]:
+        # Restituisce (frame successivi ad after_id, nuovo last id).
+        # None se after_id è uscito dallo storico: il client deve ripartire da uno snapshot.
+        with self._cond:
+            if after_id > self.last_id:
+                # non dovrebbe accadere a parità di epoca (vedi parse_event_id)
+                return None, self.last_id
+            if self.last_id == after_id:
+                self._cond.wait(timeout)
+            if self._events and after_id < self._events[0][0] - 1:
+                return None, self.last_id
+            frames = [f for eid, f in self._events if eid > after_id]
+            return frames, self.last_id
+
+    def subscribe(self, limit: int) -> bool:
+        with self._cond:
+            if self.subscribers >= limit:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+
+# ---------------------------------------------------------------------------
+# SHARDING UGRID
+# ---------------------------------------------------------------------------
+
+class HashRing:
+    # Hash consistente: all'uscita di un nodo si spostano solo le sue uGrid
+    def __init__(self, nodes, vnodes: int = SHARD_VNODES):
+        self.nodes = tuple(sorted(nodes))
+        points = sorted((self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._keys = [h for h, _ in points]
+        self._owners = [n for _, n in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._owners[i]
+
+
+def renew_node_lease(node_id: str):
+    # Scadenza calcolata sull'orologio del DB: nessuna dipendenza dagli orologi dei nodi
+    with db_write_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO rca_nodes (node_id, expires_at) VALUES (%s, UNIX_TIMESTAMP(NOW(6)) + %s)
+            ON DUPLICATE KEY UPDATE expires_at = VALUES(expires_at)
+        """, (node_id, SHARD_LEASE_TTL_SEC))
+        cur.close()
+
+
+def release_node_lease(node_id: str):
+    with db_write_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM rca_nodes WHERE node_id=%s", (node_id,))
+        cur.close()
+
+
+def live_nodes() -> list:
+    with db_read_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT node_id FROM rca_nodes WHERE expires_at > UNIX_TIMESTAMP(NOW(6))")
+        nodes = [r[0] for r in cur.fetchall()]
+        cur.close()
+    return nodes
+
+
+# ---------------------------------------------------------------------------
+# STATO CONDIVISO TRA WORKER (gunicorn multi-processo)
+# ---------------------------------------------------------------------------
+
+class SharedStateSync:
+    # Ogni voce di rca_shared_state ha una versione: chi modifica incrementa,
+    # gli altri processi ricaricano quando la versione cambia.
+    #   status:<nodo>  snapshot ultimo stato del nodo (pubblicato dal leader, body CBOR);
+    #                  con lo sharding gli snapshot degli altri nodi compongono /api/status
+    #   objectives  obiettivi modificati (ricarica dalla tabella objectives)
+    #   prices      prezzi MPC modificati (ricarica da mpc_params)
+    #   ugrids      registro uGrid modificato (ricarica dalla tabella ugrids)
+    #   alert_rules regole alert modificate (ricaricate dal solo leader, che le valuta)
+    def __init__(self, rca: "RCA"):
+        self.rca = rca
+        self.is_leader = False
+        self._lock_conn = None
+        self._next_lead_try = 0.0
+        self._versions: Dict[str, int] = {}
+        self._published_version = -1
+        self._last_publish = 0.0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="shared-state", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.join(SHARED_STATE_SYNC_SEC * 5)
+        if self._lock_conn is not None:
+            if SHARD_ENABLED:
+                try:
+                    release_node_lease(RCA_NODE_ID)  # ribilanciamento immediato
+                except Exception as e:
+                    logger.error(f"Errore rilascio lease nodo {RCA_NODE_ID}: {e}")
+            MySQLPool._close_quietly(self._lock_conn)  # rilascia GET_LOCK
+            self._lock_conn = None
+        self.is_leader = False
+
+    def bump(self, name: str):
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO rca_shared_state (name, version) VALUES (%s, 1)
+                ON DUPLICATE KEY UPDATE version = version + 1
+            """, (name,))
+            cur.close()
+
+    def _try_lead(self) -> bool:
+        # Connessione del pool scritture: se il lock è preso torna al pool, altrimenti
+        # resta al leader finché lo tiene. Tentativi radi e sfasati tra i worker
+        now = time.time()
+        if now < self._next_lead_try:
+            return False
+        self._next_lead_try = now + SHARED_STATE_LEAD_RETRY_SEC * random.uniform(0.5, 1.5)
+        conn = db_write_pool.take()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT GET_LOCK(%s, 0)", (ENGINE_LOCK_NAME,))
+            got = cur.fetchone()[0] == 1
+            cur.close()
+        except Exception:
+            MySQLPool._close_quietly(conn)
+            raise
+        if not got:
+            db_write_pool.give_back(conn)
+            return False
+        self._lock_conn = conn
+        return True
+
+    def _check_lead(self) -> bool:
+        # Il lock vive quanto la connessione: se cade, un altro worker può averlo preso
+        try:
+            self._lock_conn.ping(reconnect=False)
+            return True
+        except Exception:
+            MySQLPool._close_quietly(self._lock_conn)
+            self._lock_conn = None
+            return False
+
+    def _publish_status(self):
+        body = cbor2.dumps(self.rca.export_snapshot())
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO rca_shared_state (name, version, body) VALUES (%s, 1, %s)
+                ON DUPLICATE KEY UPDATE version = version + 1, body = VALUES(body)
+            """, (f"status:{RCA_NODE_ID}", body))
+            cur.close()
+
+    def _load_status(self, name):
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT body FROM rca_shared_state WHERE name=%s", (name,))
+            row = cur.fetchone()
+            cur.close()
+        if not row or not row[0]:
+            return
+        node = name.split(":", 1)[1]
+        if node == RCA_NODE_ID:
+            self.rca.import_snapshot(cbor2.loads(row[0]))
+        elif SHARD_ENABLED:
+            self.rca.import_remote_slice(node, cbor2.loads(row[0]))
+
+    def _sync(self):
+        if SHARD_ENABLED:
+            if self.is_leader:
+                renew_node_lease(RCA_NODE_ID)
+            self.rca.set_shard_members(live_nodes())
+
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT name, version FROM rca_shared_state")
+            versions = dict(cur.fetchall())
+            cur.close()
+        changed = {n for n, v in versions.items() if self._versions.get(n) != v}
+        self._versions = versions
+        if "ugrids" in changed:
+            ugrid_registry.load()
+        if "alert_rules" in changed and self.is_leader:
+            self.rca.alert_engine.reload()
+        if "objectives" in changed:
+            self.rca.load_objectives()
+        if "prices" in changed:
+            self.rca.load_prices()
+        for name in changed:
+            if name.startswith("status:") and not (self.is_leader and name == f"status:{RCA_NODE_ID}"):
+                self._load_status(name)
+
+    def _run(self):
+        while not self.rca.stop_event.is_set():
+            try:
+                if self.is_leader and not self._check_lead():
+                    logger.critical("Lock del poll engine perso, arresto engine locale")
+                    self.is_leader = False
+                    self.rca.stop_engine()
+                if not self.is_leader and self._try_lead():
+                    logger.info(f"Worker {os.getpid()} eletto leader: avvio poll engine")
+                    self.is_leader = True
+                    if SHARD_ENABLED:
+                        # Il lease va registrato prima che l'engine calcoli le uGrid assegnate
+                        renew_node_lease(RCA_NODE_ID)
+                        self.rca.set_shard_members(live_nodes())
+                    self.rca.start_engine()
+                self._sync()
+                now = time.time()
+                if (self.is_leader and self.rca.status_version != self._published_version
+                        and now - self._last_publish >= SHARED_STATE_PUBLISH_SEC):
+                    self._published_version = self.rca.status_version
+                    self._last_publish = now
+                    self._publish_status()
+            except Exception as e:
+                logger.error(f"Errore sincronizzazione stato condiviso: {e}")
+            self.rca.stop_event.wait(SHARED_STATE_SYNC_SEC)
+
 
 # ---------------------------------------------------------------------------
 # CORE RCA
 # ---------------------------------------------------------------------------
 
+# Campi telemetria mantenuti nello snapshot in memoria per /api/status
+LATEST_STATE_FIELDS = (
+    "soc", "soh", "voltage", "temperature", "current", "power_kw",
+    "optimal_u_kw", "grid_power_kw", "profit_eur", "ts",
+)
+
 class RCA:
     def __init__(self):
         self.stop_event = threading.Event()
+        self.engine_stop = threading.Event()  # poll engine (sottoinsieme di stop_event)
         self.mqtt_pub = MqttPublisher(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
-        self.db_lock = threading.Lock()
         self.logger = logger
-        self.ugrid_price: Dict[str, float] = {
-            ugrid_id: ENERGY_PRICE_EUR_PER_KWH for ugrid_id in UGRIDS.keys()
-        }
-        self.latest_batt_extra: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        # Prezzi di default per le uGrid senza mpc_params (vedi load_prices)
+        self.ugrid_price: Dict[str, float] = {}
+        # Snapshot autorevole dell'ultimo campione per batteria e aggregati per uGrid
+        self.state_lock = InstrumentedLock("state")
+        self.latest_telemetry: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self.ugrid_agg: Dict[str, Dict[str, Any]] = {}
+        # Somma di |p| delle batterie in latest_telemetry per uGrid, aggiornata a ogni batch:
+        # la usa lo scheduler senza scorrere tutte le batterie
+        self.ugrid_abs_power: Dict[str, float] = {}
+        self.objectives_lock = InstrumentedLock("objectives")
+        self.objectives: Dict[str, Dict[int, Tuple[str, Optional[float]]]] = {}
+        self.telemetry_writer = TelemetryWriter(db_write_pool)
+        self.alert_engine = AlertEngine(self.mqtt_pub)
+        self.events = StatusEventBroker()
+        # Versione dello snapshot (ETag di /api/status e ?since=); l'istanza distingue i riavvii
+        self.instance_id = f"{int(time.time() * 1000):x}"
+        # None = processo singolo; con gunicorn ogni worker ha il suo SharedStateSync
+        self.shared: Optional[SharedStateSync] = None
+        # Sharding: ring dei nodi vivi e snapshot pubblicati dagli altri nodi
+        self.shard_ring: Optional[HashRing] = None
+        self.remote_slices: Dict[str, Dict[str, Any]] = {}
+        self._engine_threads: list = []
+        self.status_version = 0
+        self.ugrid_versions: Dict[str, int] = {}
+        self.battery_versions: Dict[Tuple[str, int], int] = {}
+        # Poll engine: i worker scaricano /dev/state, il poll thread consuma la coda
+        self.dispatcher = ObjectiveDispatcher()
+        self.poll_executor = ThreadPoolExecutor(max_workers=POLL_MAX_WORKERS,
+                                                thread_name_prefix="poll")
+        self.ingest_queue: "Queue[Optional[Tuple[str, Dict[str, Any], float]]]" = Queue()
+        self.last_ts: Dict[str, float] = {}
+        self._inflight: Dict[str, Future] = {}
+        self.poll_scheduler = PollScheduler()
+        self.observers: Dict[str, UgridObserver] = {}
 
     # --- DB Helpers ------------------------------------------------
-    def insert_telemetry(self, ugrid_id, battery_index, row):
-        with self.db_lock:
-            conn = get_mysql_connection(DB_NAME)
-            try:
-                cur = conn.cursor()
-                cur.execute("""
-                    INSERT INTO telemetry (
-                        ugrid_id, battery_index, soc, soh, voltage, temperature,
-                        current, power_kw, optimal_u_kw, grid_power_kw,
-                        load_kw, pv_kw, profit_eur
-                    ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                """, (ugrid_id, battery_index, row.get("soc"), row.get("soh"), row.get("voltage"),
-                      row.get("temperature"), row.get("current"), row.get("power_kw"), row.get("optimal_u_kw"),
-                      row.get("grid_power_kw"), row.get("load_kw"), row.get("pv_kw"), row.get("profit_eur")))
-                conn.commit()
-            finally:
-                conn.close()
-
-    def insert_alert(self, level, ugrid_id, battery_index, message, payload):
-        with self.db_lock:
-            conn = get_mysql_connection(DB_NAME)
-            try:
-                cur = conn.cursor()
-                cur.execute("""
-                    INSERT INTO alerts (level, ugrid_id, battery_index, message, payload)
-                    VALUES (%s,%s,%s,%s,%s)
-                """, (level, ugrid_id, battery_index, message, json.dumps(payload) if payload else None))
-                conn.commit()
-            finally:
-                conn.close()
-        self.mqtt_pub.publish_alert(level, ugrid_id, battery_index, message, payload)
-
     def upsert_objective(self, ugrid_id, battery_index, mode, target_soc):
-        with self.db_lock:
-            conn = get_mysql_connection(DB_NAME)
-            try:
-                cur = conn.cursor()
-                cur.execute("""
-                    INSERT INTO objectives (ugrid_id, battery_index, mode, target_soc)
-                    VALUES (%s,%s,%s,%s)
-                    ON DUPLICATE KEY UPDATE mode=VALUES(mode), target_soc=VALUES(target_soc)
-                """, (ugrid_id, battery_index, mode, target_soc))
-                conn.commit()
-            finally:
-                conn.close()
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO objectives (ugrid_id, battery_index, mode, target_soc)
+                VALUES (%s,%s,%s,%s)
+                ON DUPLICATE KEY UPDATE mode=VALUES(mode), target_soc=VALUES(target_soc)
+            """, (ugrid_id, battery_index, mode, target_soc))
+            conn.commit()
+        self._set_objective(ugrid_id, int(battery_index),
+                            (mode, float(target_soc) if target_soc is not None else None))
+        self._notify_shared("objectives")
 
     def delete_objective(self, ugrid_id, battery_index):
-        with self.db_lock:
-            conn = get_mysql_connection(DB_NAME)
-            try:
-                cur = conn.cursor()
-                cur.execute("DELETE FROM objectives WHERE ugrid_id=%s AND battery_index=%s", 
-                            (ugrid_id, battery_index))
-                conn.commit()
-            finally:
-                conn.close()
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM objectives WHERE ugrid_id=%s AND battery_index=%s", 
+                        (ugrid_id, battery_index))
+            conn.commit()
+        self._set_objective(ugrid_id, int(battery_index), None)
+        self._notify_shared("objectives")
+
+    def _notify_shared(self, name):
+        if self.shared is None:
+            return
+        try:
+            self.shared.bump(name)
+        except Exception as e:
+            logger.error(f"Errore notifica stato condiviso '{name}': {e}")
+
+    def load_prices(self):
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT ugrid_id, price FROM mpc_params")
+            rows = cur.fetchall()
+        for ugrid_id, price in rows:
+            if self.ugrid_price.get(ugrid_id) != price:
+                self.ugrid_price[ugrid_id] = price
+                with self.state_lock:
+                    self._bump_version(ugrid_id)
+
+    # --- Cache obiettivi (write-through, copy-on-write) ------------
+    def load_objectives(self):
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT ugrid_id, battery_index, mode, target_soc FROM objectives")
+            rows = cur.fetchall()
+        out: Dict[str, Dict[int, Tuple[str, Optional[float]]]] = {}
+        for ugrid_id, idx, mode, target_soc in rows:
+            out.setdefault(ugrid_id, {})[int(idx)] = (
+                mode, float(target_soc) if target_soc is not None else None)
+        with self.objectives_lock:
+            old = self.objectives
+            removed = [(ug, idx) for ug, per in old.items() for idx in per
+                       if idx not in out.get(ug, {})]
+            changed = [(ug, idx) for ug, per in out.items() for idx, obj in per.items()
+                       if old.get(ug, {}).get(idx) != obj]
+            self.objectives = out
+        # Solo le batterie con obiettivo cambiato: le altre tengono il comando confermato
+        for ugrid_id, idx in changed + removed:
+            self.dispatcher.invalidate(ugrid_id, idx)
+        # Obiettivi cancellati da un altro worker/nodo: il clear parte dal processo che
+        # comanda la uGrid, serializzato con eventuali PUT ancora in volo
+        if self._engine_threads:
+            for ugrid_id, idx in removed:
+                if self.owns_ugrid(ugrid_id):
+                    self.dispatcher.submit(ugrid_id, idx, clear=True)
+        logger.info(f"Cache obiettivi caricata ({len(rows)} obiettivi)")
+
+    def _set_objective(self, ugrid_id, battery_index, objective):
+        # I lettori non prendono lock: si sostituisce il dict della uGrid, mai modificato in place
+        with self.objectives_lock:
+            per_ugrid = dict(self.objectives.get(ugrid_id, {}))
+            if objective is None:
+                per_ugrid.pop(battery_index, None)
+            else:
+                per_ugrid[battery_index] = objective
+            objectives = dict(self.objectives)
+            objectives[ugrid_id] = per_ugrid
+            self.objectives = objectives
+        self.dispatcher.invalidate(ugrid_id, battery_index)
+
+        with self.state_lock:
+            self._bump_version(ugrid_id, [battery_index])
+        row = self.latest_telemetry.get((ugrid_id, battery_index))
+        if row is not None and self.events.subscribers:
+            obj_mode, obj_tgt = objective or (None, None)
+            self.events.publish("ugrid", {"ugrid_id": ugrid_id, "batteries": [{
+                "index": battery_index, "objective_mode": obj_mode, "objective_target_soc": obj_tgt,
+            }]})
 
     def get_objectives_for_ugrid(self, ugrid_id):
-        with self.db_lock:
-            conn = get_mysql_connection(DB_NAME)
-            try:
-                cur = conn.cursor()
-                cur.execute("SELECT battery_index, mode, target_soc FROM objectives WHERE ugrid_id=%s", (ugrid_id,))
-                rows = cur.fetchall()
-            finally:
-                conn.close()
-        out = {}
-        for idx, mode, target_soc in rows:
-            out[int(idx)] = (mode, float(target_soc) if target_soc is not None else None)
-        return out
+        # Restituisce un dict da trattare in sola lettura
+        return self.objectives.get(ugrid_id, {})
 
-    def get_latest_status(self):
-        # (Logica identica all'originale per aggregare dati DB)
-        with self.db_lock:
-            conn = get_mysql_connection(DB_NAME)
-            try:
-                cur = conn.cursor(dictionary=True)
-                cur.execute("""
-                    SELECT t.* FROM telemetry t
-                    JOIN (SELECT ugrid_id, battery_index, MAX(ts) AS ts FROM telemetry GROUP BY ugrid_id, battery_index) last
-                    ON t.ugrid_id = last.ugrid_id AND t.battery_index = last.battery_index AND t.ts = last.ts
-                    ORDER BY t.ugrid_id, t.battery_index
-                """)
-                rows = cur.fetchall()
-            finally:
-                conn.close()
+    # --- Snapshot ultimo stato ------------------------------------
+    def load_latest_status(self):
+        # Cold start: ricostruisce lo snapshot dall'ultima riga per batteria nel DB
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor(dictionary=True)
+            cur.execute("""
+                SELECT t.* FROM telemetry t
+                JOIN (SELECT ugrid_id, battery_index, MAX(ts) AS ts FROM telemetry GROUP BY ugrid_id, battery_index) last
+                ON t.ugrid_id = last.ugrid_id AND t.battery_index = last.battery_index AND t.ts = last.ts
+                ORDER BY t.ugrid_id, t.battery_index
+            """)
+            rows = cur.fetchall()
+
+        with self.state_lock:
+            for r in rows:
+                ugrid_id = r["ugrid_id"]
+                key = (ugrid_id, r["battery_index"])
+                if key in self.latest_telemetry:
+                    continue
+                self.latest_telemetry[key] = {k: r[k] for k in LATEST_STATE_FIELDS}
+                agg = self.ugrid_agg.setdefault(ugrid_id, {
+                    "load_kw": r["load_kw"], "pv_kw": r["pv_kw"], "grid_power_kw": r["grid_power_kw"],
+                })
+                if r["grid_power_kw"] is not None: agg["grid_power_kw"] = r["grid_power_kw"]
+                self._bump_version(ugrid_id, [r["battery_index"]])
+            self.ugrid_abs_power = self._abs_power_totals(self.latest_telemetry)
+        logger.info(f"Snapshot stato caricato dal DB ({len(rows)} batterie)")
+
+    def _update_latest(self, ugrid_id, batteries, load_kw, pv_kw, grid_power_kw, abs_power):
+        # abs_power: somma di |p| del batch, già calcolata sulle colonne
+        agg = {"load_kw": load_kw, "pv_kw": pv_kw, "grid_power_kw": grid_power_kw}
+        keys = [(ugrid_id, idx) for idx, _ in batteries]
+        with self.state_lock:
+            latest = self.latest_telemetry
+            old_rows = [latest.get(k) for k in keys]
+            latest.update(zip(keys, (row for _, row in batteries)))
+            old_power = np.array([r["power_kw"] for r in old_rows if r is not None], dtype=np.float64)
+            total = self.ugrid_abs_power.get(ugrid_id, 0.0) + abs_power - float(np.nansum(np.abs(old_power)))
+            self.ugrid_abs_power[ugrid_id] = max(total, 0.0)  # deriva di arrotondamento
+            self.ugrid_agg[ugrid_id] = agg
+            self._bump_version(ugrid_id, [idx for idx, _ in batteries])
+        if self.events.subscribers:
+            prev = {idx: r for (_, idx), r in zip(keys, old_rows) if r is not None}
+            self._publish_ugrid_delta(ugrid_id, batteries, prev, dict(agg))
+
+    @staticmethod
+    def _abs_power_totals(latest) -> Dict[str, float]:
+        totals: Dict[str, float] = {}
+        for (ugrid_id, _), r in latest.items():
+            totals[ugrid_id] = totals.get(ugrid_id, 0.0) + abs(float(r["power_kw"] or 0.0))
+        return totals
+
+    @staticmethod
+    def _battery_status(idx, r, objectives):
+        obj_mode, obj_tgt = objectives.get(idx, (None, None))
+        return {
+            "index": idx, "soc": r["soc"], "soh": r["soh"], "voltage": r["voltage"],
+            "temperature": r["temperature"], "current": r["current"], "power_kw": r["power_kw"],
+            "optimal_u_kw": r["optimal_u_kw"], "grid_power_kw": r["grid_power_kw"],
+            "profit_eur": r["profit_eur"], "state": r.get("state"), "ip": r.get("ip"),
+            "objective_mode": obj_mode, "objective_target_soc": obj_tgt, "ts": r["ts"].isoformat()
+        }
+
+    def _publish_ugrid_delta(self, ugrid_id, batteries, prev, agg=None):
+        # Evento SSE con i soli campi cambiati per batteria rispetto allo snapshot precedente
+        if not self.events.subscribers:
+            return
+        objectives = self.get_objectives_for_ugrid(ugrid_id)
+        deltas = []
+        for idx, row in batteries:
+            new = self._battery_status(idx, row, objectives)
+            old = prev.get(idx)
+            if old is not None:
+                old = self._battery_status(idx, old, objectives)
+                new = {k: v for k, v in new.items() if k == "index" or old.get(k) != v}
+            if len(new) > 1:
+                deltas.append(new)
+        if not deltas and agg is None:
+            return
+        data: Dict[str, Any] = {"ugrid_id": ugrid_id, "batteries": deltas}
+        if agg is not None:
+            price = self.ugrid_price.get(ugrid_id, ENERGY_PRICE_EUR_PER_KWH)
+            grid_p = agg.get("grid_power_kw")
+            data.update(agg, price_eur_per_kwh=price,
+                        profit_eur_per_hour=-grid_p * price if grid_p is not None else None)
+        self.events.publish("ugrid", data)
+
+    @property
+    def owns_state(self) -> bool:
+        # Solo il processo che esegue il poll engine fa avanzare le versioni dello snapshot
+        return self.shared is None or self.shared.is_leader
+
+    def _bump_version(self, ugrid_id, battery_indexes=()):
+        # Da chiamare con state_lock acquisito
+        if not self.owns_state:
+            return
+        self.status_version += 1
+        self.ugrid_versions[ugrid_id] = self.status_version
+        for idx in battery_indexes:
+            self.battery_versions[(ugrid_id, idx)] = self.status_version
+
+    def export_snapshot(self) -> Dict[str, Any]:
+        with self.state_lock:
+            return {
+                "instance": self.instance_id, "version": self.status_version,
+                "rows": [[ug, idx, dict(r, ts=r["ts"].timestamp())]
+                         for (ug, idx), r in self.latest_telemetry.items()],
+                "aggs": self.ugrid_agg,
+                "ugrid_versions": self.ugrid_versions,
+                "battery_versions": [[ug, idx, v] for (ug, idx), v in self.battery_versions.items()],
+            }
+
+    @staticmethod
+    def _decode_snapshot(snap):
+        latest = {(ug, idx): dict(r, ts=datetime.fromtimestamp(r["ts"])) for ug, idx, r in snap["rows"]}
+        versions = {(ug, idx): v for ug, idx, v in snap["battery_versions"]}
+        return latest, versions
+
+    def _publish_snapshot_deltas(self, old_latest, old_versions, latest, versions, aggs):
+        changed: Dict[str, list] = {}
+        for key, v in versions.items():
+            if old_versions.get(key) != v:
+                changed.setdefault(key[0], []).append((key[1], latest[key]))
+        for ugrid_id, batteries in changed.items():
+            prev = {idx: old_latest[(ugrid_id, idx)] for idx, _ in batteries
+                    if (ugrid_id, idx) in old_latest}
+            self._publish_ugrid_delta(ugrid_id, batteries, prev, dict(aggs.get(ugrid_id, {})))
+
+    def import_snapshot(self, snap: Dict[str, Any]):
+        # Worker non leader: adotta lo snapshot (e le versioni) del leader
+        latest, versions = self._decode_snapshot(snap)
+        with self.state_lock:
+            old_latest, old_versions = self.latest_telemetry, self.battery_versions
+            self.latest_telemetry = latest
+            self.ugrid_agg = snap["aggs"]
+            self.ugrid_abs_power = self._abs_power_totals(latest)
+            self.instance_id = snap["instance"]
+            self.status_version = snap["version"]
+            self.ugrid_versions = snap["ugrid_versions"]
+            self.battery_versions = versions
+        self._publish_snapshot_deltas(old_latest, old_versions, latest, versions, snap["aggs"])
+
+    def import_remote_slice(self, node_id: str, snap: Dict[str, Any]):
+        # Sharding: snapshot delle uGrid di un altro nodo, servito in /api/status
+        latest, versions = self._decode_snapshot(snap)
+        old = self.remote_slices.get(node_id) or {"latest": {}, "battery_versions": {}}
+        self.remote_slices[node_id] = {
+            "instance": snap["instance"], "version": snap["version"],
+            "latest": latest, "aggs": snap["aggs"], "battery_versions": versions,
+        }
+        self._publish_snapshot_deltas(old["latest"], old["battery_versions"], latest, versions, snap["aggs"])
+
+    # --- Sharding ---
+    def set_shard_members(self, nodes):
+        if self.owns_state and RCA_NODE_ID not in nodes:
+            nodes = list(nodes) + [RCA_NODE_ID]
+        if self.shard_ring is not None and self.shard_ring.nodes == tuple(sorted(nodes)):
+            return
+        logger.info(f"Membership shard aggiornata: {sorted(nodes)}")
+        self.shard_ring = HashRing(nodes)
+        for node in list(self.remote_slices):
+            if node not in nodes:
+                del self.remote_slices[node]
+
+    def owns_ugrid(self, ugrid_id) -> bool:
+        return self.shard_ring is None or self.shard_ring.owner(ugrid_id) == RCA_NODE_ID
+
+    def owned_ugrids(self) -> Dict[str, Dict[str, Any]]:
+        return {ug: cfg for ug, cfg in ugrid_registry.all().items() if self.owns_ugrid(ug)}
+
+    def _prune_ugrids(self):
+        # Poll thread: rilascia observe e snapshot delle uGrid rimosse dal registro
+        # o passate ad altri nodi
+        owned = self.owned_ugrids()
+        for ugrid_id in [ug for ug, obs in self.observers.items()
+                         if ug not in owned or obs.uri != owned[ug]["coap_state_uri"]]:
+            logger.info(f"uGrid {ugrid_id} rimossa o modificata: observe cancellato")
+            self.observers.pop(ugrid_id).cancel()
+        for ugrid_id in [ug for ug in self.last_ts if ug not in owned]:
+            self.last_ts.pop(ugrid_id)
+            self._inflight.pop(ugrid_id, None)
+        with self.state_lock:
+            lost = [key for key in self.latest_telemetry if key[0] not in owned]
+            for key in lost:
+                del self.latest_telemetry[key]
+                self.battery_versions.pop(key, None)
+            gone = {ug for ug, _ in lost}
+            for ugrid_id in gone:
+                self.ugrid_agg.pop(ugrid_id, None)
+                self.ugrid_abs_power.pop(ugrid_id, None)
+                self._bump_version(ugrid_id)  # tombstone nei delta ?since= (vedi get_latest_status)
+        if self.events.subscribers:
+            for ugrid_id in sorted(gone):
+                self.events.publish("ugrid_removed", {"ugrid_id": ugrid_id})
+
+    def status_tag(self) -> Tuple[str, int]:
+        # (istanza, versione) per ETag/X-Status-*: con lo sharding combina tutti i nodi.
+        # L'istanza dipende solo da (nodo, istanza): cambia a un riavvio o cambio membri,
+        # non a ogni aggiornamento
+        if self.shard_ring is None:
+            return self.instance_id, self.status_version
+        parts = [(RCA_NODE_ID, self.instance_id, self.status_version)] + sorted(
+            (node, sl["instance"], sl["version"]) for node, sl in self.remote_slices.items())
+        digest = hashlib.md5(repr([(n, i) for n, i, _ in parts]).encode("utf-8")).hexdigest()[:16]
+        return f"shard-{digest}", sum(v for _, _, v in parts)
+
+    def get_latest_status(self, since: Optional[int] = None):
+        # since: solo uGrid/batterie modificate dopo quella versione (None o versione futura = tutto)
+        if self.shard_ring is not None:
+            since = None  # versioni per nodo non confrontabili: sempre snapshot completo
+        with self.state_lock:
+            items = list(self.latest_telemetry.items())
+            aggs = {ug: dict(a) for ug, a in self.ugrid_agg.items()}
+            if since is not None and since > self.status_version:
+                since = None
+            if since is not None:
+                changed_batts = {k for k, v in self.battery_versions.items() if v > since}
+                changed_ugrids = {ug for ug, v in self.ugrid_versions.items() if v > since}
+
+        for node, sl in list(self.remote_slices.items()):
+            if self.shard_ring is None:
+                break
+            owned = {ug for ug, _ in sl["latest"] if self.shard_ring.owner(ug) == node}
+            items.extend((key, r) for key, r in sl["latest"].items() if key[0] in owned)
+            aggs.update((ug, dict(a)) for ug, a in sl["aggs"].items() if ug in owned)
+        items.sort(key=lambda kv: kv[0])
 
         res = {}
         profit_totals = {}
-        objectives_all = {ug: self.get_objectives_for_ugrid(ug) for ug in UGRIDS.keys()}
+        objectives_all = {ug: self.get_objectives_for_ugrid(ug) for ug in ugrid_registry.all()}
 
-        for r in rows:
-            ugrid_id = r["ugrid_id"]
-            idx = r["battery_index"]
+        for (ugrid_id, idx), r in items:
+            if since is not None and ugrid_id not in changed_ugrids:
+                continue
             if ugrid_id not in res:
+                agg = aggs.get(ugrid_id, {})
                 res[ugrid_id] = {
-                    "load_kw": r["load_kw"], "pv_kw": r["pv_kw"], "grid_power_kw": r["grid_power_kw"],
+                    "load_kw": agg.get("load_kw"), "pv_kw": agg.get("pv_kw"),
+                    "grid_power_kw": agg.get("grid_power_kw"),
                     "price_eur_per_kwh": self.ugrid_price.get(ugrid_id, ENERGY_PRICE_EUR_PER_KWH),
                     "batteries": []
                 }
                 profit_totals[ugrid_id] = 0.0
-            else:
-                if r["grid_power_kw"] is not None: res[ugrid_id]["grid_power_kw"] = r["grid_power_kw"]
-            
+
             if r["profit_eur"] is not None: profit_totals[ugrid_id] += float(r["profit_eur"])
 
-            extra = self.latest_batt_extra.get((ugrid_id, idx), {})
-            obj_mode, obj_tgt = None, None
-            if idx in objectives_all.get(ugrid_id, {}):
-                obj_mode, obj_tgt = objectives_all[ugrid_id][idx]
+            if since is not None and (ugrid_id, idx) not in changed_batts:
+                continue
+            res[ugrid_id]["batteries"].append(
+                self._battery_status(idx, r, objectives_all.get(ugrid_id, {})))
 
-            res[ugrid_id]["batteries"].append({
-                "index": idx, "soc": r["soc"], "soh": r["soh"], "voltage": r["voltage"],
-                "temperature": r["temperature"], "current": r["current"], "power_kw": r["power_kw"],
-                "optimal_u_kw": r["optimal_u_kw"], "grid_power_kw": r["grid_power_kw"],
-                "profit_eur": r["profit_eur"], "state": extra.get("state"), "ip": extra.get("ip"),
-                "objective_mode": obj_mode, "objective_target_soc": obj_tgt, "ts": r["ts"].isoformat()
-            })
+        if since is not None:
+            # uGrid modificate dopo since ma senza più righe: rimosse, il client le scarta
+            present = {ug for (ug, _), _ in items}
+            for ugrid_id in sorted(changed_ugrids - present):
+                res[ugrid_id] = None
 
         for ugrid_id, info in res.items():
+            if info is None:
+                continue
             grid_p = info.get("grid_power_kw")
             if grid_p is not None:
                 info["profit_eur_per_hour"] = -grid_p * info["price_eur_per_kwh"]
@@ -499,30 +2968,22 @@ class RCA:
         # FULL DISCHARGE
         if mode == "full_discharge":
             if soc > 0.05:
-                power_kw = MAX_DISCH_POWER_KW
-                try:
-                    send_ugrid_objective(ugrid_id, battery_index, power_kw)
-                except Exception as e:
-                    self.logger.error(f"Errore CoAP full_discharge: {e}")
+                self.dispatcher.submit(ugrid_id, battery_index, MAX_DISCH_POWER_KW)
                 return
             
             # Completato
-            try:
-                clear_ugrid_objective(ugrid_id, battery_index)
-            except Exception: pass
+            self.dispatcher.submit(ugrid_id, battery_index, clear=True)
             self.delete_objective(ugrid_id, battery_index)
-            self.insert_alert("info", ugrid_id, battery_index, "Scarica completa terminata", {"soc": soc})
+            self.alert_engine.notify("info", ugrid_id, battery_index, "Scarica completa terminata", {"soc": soc})
             return
 
         # TARGET SOC
         if mode == "target_soc":
             if target_soc is None: return
             if abs(soc - target_soc) <= 0.02:
-                try:
-                    clear_ugrid_objective(ugrid_id, battery_index)
-                except Exception: pass
+                self.dispatcher.submit(ugrid_id, battery_index, clear=True)
                 self.delete_objective(ugrid_id, battery_index)
-                self.insert_alert("info", ugrid_id, battery_index, "Target SoC raggiunto", {"soc": soc})
+                self.alert_engine.notify("info", ugrid_id, battery_index, "Target SoC raggiunto", {"soc": soc})
                 return
 
             error = target_soc - soc
@@ -531,127 +2992,198 @@ class RCA:
             else:
                 power_kw = max(MAX_DISCH_POWER_KW, MAX_DISCH_POWER_KW * (-error) * 5.0)
             
-            try:
-                send_ugrid_objective(ugrid_id, battery_index, power_kw)
-            except Exception as e:
-                self.logger.error(f"Errore CoAP target_soc: {e}")
+            self.dispatcher.submit(ugrid_id, battery_index, power_kw)
             return
 
         # DETACH
         if mode == "detach":
-            try:
-                send_ugrid_objective(ugrid_id, battery_index, 0.0)
-            except Exception: pass
+            self.dispatcher.submit(ugrid_id, battery_index, 0.0)
             self.delete_objective(ugrid_id, battery_index)
-            self.insert_alert("info", ugrid_id, battery_index, "Batteria staccata (detach)", {})
+            self.alert_engine.notify("info", ugrid_id, battery_index, "Batteria staccata (detach)", {})
             return
 
     # --- Polling Loop ---
-    def _handle_ugrid_state(self, ugrid_id, state, dt_hours):
-        # (Logica identica per calcoli e parsing)
-        bats = state.get("bats", []) or []
+    def _handle_ugrid_state(self, ugrid_id, state, dt_hours, ts=None):
+        # Elaborazione colonnare: potenze, profitto e soglie come operazioni su array
+        ts = ts or time.time()
+        ts_dt = datetime.fromtimestamp(ts)
         load_kw = state.get("load_kw")
         pv_kw = state.get("pv_kw")
         price = self.ugrid_price.get(ugrid_id, ENERGY_PRICE_EUR_PER_KWH)
-        
+        if "columns" in state:
+            # CBOR: colonne già pronte dal decoder
+            idx, values, states = state["columns"]
+            ips = [None] * len(states)
+        else:
+            bats = state.get("bats", []) or []
+            idx, values = battery_columns(bats)
+            states = [b.get("state") for b in bats]
+            ips = [b.get("ip") for b in bats]
+        n = len(idx)
+        power = values[:, BATT_P]
+
         grid_power_kw = None
         if load_kw is not None and pv_kw is not None:
-            total_p = sum(b.get("p", 0.0) or 0.0 for b in bats)
-            grid_power_kw = load_kw + total_p - pv_kw
-        
-        profit_eur_total = None
+            grid_power_kw = float(load_kw + np.nansum(power) - pv_kw)
+
+        # Profitto ripartito tra le batterie in proporzione a |p| (NaN dove p manca)
+        profit = np.full(n, np.nan)
         if grid_power_kw is not None and dt_hours > 0:
             profit_eur_total = -price * grid_power_kw * dt_hours
-        
-        total_abs_power = sum(abs(b.get("p", 0.0) or 0.0) for b in bats) or 1.0
-        objectives = self.get_objectives_for_ugrid(ugrid_id)
+            profit = profit_eur_total * np.abs(power) / (np.nansum(np.abs(power)) or 1.0)
+
+        # Righe nell'ordine di TELEMETRY_COLUMNS, accodate al writer in un solo batch
+        table = np.empty((n, len(TELEMETRY_COLUMNS)), dtype=object)
+        col = _TELEMETRY_COL
+        table[:, col["ugrid_id"]] = ugrid_id
+        table[:, col["battery_index"]] = idx.tolist()
+        table[:, col["ts"]] = ts
+        table[:, _BATT_COL0:_BATT_COL0 + len(BATT_FIELDS)] = _nan_to_none(values)
+        table[:, col["grid_power_kw"]] = grid_power_kw
+        table[:, col["load_kw"]] = load_kw
+        table[:, col["pv_kw"]] = pv_kw
+        table[:, col["profit_eur"]] = _nan_to_none(profit)
+        rows = list(map(tuple, table.tolist()))
+        self.telemetry_writer.enqueue_many(rows)
+
+        # Le stesse righe diventano lo snapshot in memoria (un dict per batteria, per le API)
+        latest = [(row[1], dict(zip(_TELEMETRY_ROW_FIELDS, row[3:]), ts=ts_dt, state=st, ip=ip))
+                  for row, st, ip in zip(rows, states, ips)]
+
+        if MQTT_TELEMETRY_ENABLED:
+            # colonne in sola lettura da qui in poi: il publisher le codifica al momento dell'invio
+            self.mqtt_pub.publish_snapshot(
+                f"{MQTT_TELEMETRY_TOPIC_BASE}/{ugrid_id}",
+                lambda: encode_ugrid_state_cbor(idx, values, states, load_kw, pv_kw, ts))
 
-        for b in bats:
-            idx = int(b.get("idx", 0))
-            power_kw = b.get("p")
-            soc = b.get("S")
-            soh = b.get("H")
-            temp = b.get("T")
-            
-            self.latest_batt_extra[(ugrid_id, idx)] = {
-                "state": b.get("state"), "ip": b.get("ip")
-            }
-            
-            profit_eur = None
-            if profit_eur_total is not None and power_kw is not None:
-                 profit_eur = profit_eur_total * (abs(power_kw) / total_abs_power)
-
-            row = {
-                "soc": soc, "soh": soh, "voltage": b.get("V"), "temperature": temp,
-                "current": b.get("I"), "power_kw": power_kw, "optimal_u_kw": b.get("u"),
-                "grid_power_kw": grid_power_kw, "load_kw": load_kw, "pv_kw": pv_kw,
-                "profit_eur": profit_eur
-            }
-            self.insert_telemetry(ugrid_id, idx, row)
+        try:
+            self.alert_engine.evaluate(ugrid_id, idx, values, ts)
+        except Exception as e:
+            logger.error(f"Errore valutazione alert {ugrid_id}: {e}")
 
-            # Alerts
-            if soh is not None and soh < SOH_LOW_CRITICAL:
-                self.insert_alert("critical", ugrid_id, idx, f"SoH critico {soh*100:.1f}%", {"soh": soh})
-            if temp is not None and temp > TEMP_HIGH_CRITICAL:
-                self.insert_alert("critical", ugrid_id, idx, f"Temp alta {temp:.1f}°C", {"temp": temp})
-            if soc is not None and soc < SOC_LOW_WARNING:
-                self.insert_alert("warning", ugrid_id, idx, f"SoC basso {soc*100:.1f}%", {"soc": soc})
+        objectives = self.get_objectives_for_ugrid(ugrid_id)
+        if objectives:
+            for p, i in enumerate(idx.tolist()):
+                if i in objectives:
+                    soc = values[p, BATT_SOC]
+                    self.apply_objective(ugrid_id, i, {"S": None if np.isnan(soc) else float(soc)},
+                                         objectives[i])
+
+        self._update_latest(ugrid_id, latest, load_kw, pv_kw, grid_power_kw,
+                            abs_power=float(np.nansum(np.abs(power))))
+
+    def _fetch_ugrid_state(self, ugrid_id, uri):
+        # Eseguito nei worker: solo I/O e decodifica, l'elaborazione resta sul poll thread
+        try:
+            payload, cf = coap_get(uri, timeout=POLL_TIMEOUT_SEC)
+            state = decode_ugrid_state(payload, cf)
+        except Exception as e:
+            logger.error(f"Errore poll ugrid {ugrid_id}: {e}")
+            self.ingest_queue.put((ugrid_id, None, time.time()))  # fallimento per il backoff
+            return
+        self.ingest_queue.put((ugrid_id, state, time.time()))
 
-            if idx in objectives:
-                self.apply_objective(ugrid_id, idx, b, objectives[idx])
+    def _supervise_observers(self, now):
+        if INGEST_MODE != "observe":
+            return
+        for ugrid_id, cfg in self.owned_ugrids().items():
+            obs = self.observers.get(ugrid_id)
+            if obs is None:
+                obs = UgridObserver(ugrid_id, cfg["coap_state_uri"], self.ingest_queue.put)
+                self.observers[ugrid_id] = obs
+            obs.supervise(now)
+
+    def _poll_interval(self, ugrid_id) -> float:
+        if self.get_objectives_for_ugrid(ugrid_id):
+            return POLL_INTERVAL_ACTIVE_SEC
+        abs_power = self.ugrid_abs_power.get(ugrid_id)
+        if abs_power is not None and abs_power < POLL_IDLE_POWER_KW:
+            return POLL_INTERVAL_IDLE_SEC
+        return POLL_INTERVAL_SEC
+
+    def _dispatch_polls(self, now):
+        owned = self.owned_ugrids()
+        for ugrid_id in self.poll_scheduler.pop_due(now):
+            cfg = owned.get(ugrid_id)
+            if cfg is None:
+                continue
+            self.poll_scheduler.schedule(ugrid_id, now, self._poll_interval(ugrid_id))
+            obs = self.observers.get(ugrid_id)
+            if obs is not None and obs.is_active(now):
+                # dati in arrivo tramite notifiche observe
+                continue
+            fut = self._inflight.get(ugrid_id)
+            if fut is not None and not fut.done():
+                # poll precedente ancora pendente: non accodarne un altro
+                continue
+            self._inflight[ugrid_id] = self.poll_executor.submit(
+                self._fetch_ugrid_state, ugrid_id, cfg["coap_state_uri"])
+
+    def _ingest(self, ugrid_id, state, recv_ts):
+        if ugrid_id not in ugrid_registry or not self.owns_ugrid(ugrid_id):
+            return  # risposta arrivata dopo rimozione/riassegnazione
+        # Normalizzazione numerica
+        if isinstance(state.get("load_kw"), str): state["load_kw"] = float(state["load_kw"])
+        if isinstance(state.get("pv_kw"), str): state["pv_kw"] = float(state["pv_kw"])
+
+        dt = (recv_ts - self.last_ts.get(ugrid_id, recv_ts)) / 3600.0
+        self.last_ts[ugrid_id] = recv_ts
+
+        self._handle_ugrid_state(ugrid_id, state, max(dt, POLL_INTERVAL_ACTIVE_SEC/3600.0), ts=recv_ts)
 
     def poll_loop(self):
-        logger.info("Poll loop avviato (CoAPthon sync)")
-        last_ts = {ugrid_id: time.time() for ugrid_id in UGRIDS.keys()}
-
-        while not self.stop_event.is_set():
-            start_t = time.time()
-            for ugrid_id, cfg in UGRIDS.items():
-                uri = cfg["coap_state_uri"]
-                try:
-                    # Chiamata sincrona, non c'è await
-                    payload, cf = coap_get(uri, timeout=3.0)
-                    state = decode_ugrid_state(payload, cf)
-                    
-                    # Normalizzazione numerica
-                    if isinstance(state.get("load_kw"), str): state["load_kw"] = float(state["load_kw"])
-                    if isinstance(state.get("pv_kw"), str): state["pv_kw"] = float(state["pv_kw"])
-                    
-                    now = time.time()
-                    dt = (now - last_ts.get(ugrid_id, now)) / 3600.0
-                    last_ts[ugrid_id] = now
-                    
-                    self._handle_ugrid_state(ugrid_id, state, max(dt, POLL_INTERVAL_SEC/3600.0))
-                    
-                except Exception as e:
-                    logger.error(f"Errore poll ugrid {ugrid_id}: {e}")
-
-            elapsed = time.time() - start_t
-            wait_for = max(0.0, POLL_INTERVAL_SEC - elapsed)
-            # wait gestito con Event per uscire puliti se richiesto stop
-            self.stop_event.wait(wait_for)
+        logger.info(f"Poll loop avviato (CoAPthon, modo {INGEST_MODE}, {POLL_MAX_WORKERS} worker)")
+        next_tick = time.time()
+
+        while not self.engine_stop.is_set():
+            now = time.time()
+            if now >= next_tick:
+                # supervisione a cadenza fissa, poll secondo le scadenze per uGrid
+                self._prune_ugrids()
+                self._supervise_observers(now)
+                self.poll_scheduler.sync(self.owned_ugrids().keys(), now)
+                next_tick += POLL_INTERVAL_SEC
+                if next_tick < now:
+                    next_tick = now + POLL_INTERVAL_SEC
+            self._dispatch_polls(now)
+
+            wake = min(next_tick, self.poll_scheduler.next_due() or next_tick)
+            try:
+                item = self.ingest_queue.get(timeout=max(0.0, wake - time.time()))
+            except Empty:
+                continue
+            if item is None:
+                continue
+
+            ugrid_id, state, recv_ts = item
+            self.poll_scheduler.record(ugrid_id, state is not None)
+            if state is None:
+                continue
+            try:
+                self._ingest(ugrid_id, state, recv_ts)
+            except Exception as e:
+                logger.error(f"Errore poll ugrid {ugrid_id}: {e}")
         logger.info("Poll loop terminato")
 
     def set_mpc_params(self, ugrid_id, alpha, beta, gamma, price):
         if price is None: price = ENERGY_PRICE_EUR_PER_KWH
         self.ugrid_price[ugrid_id] = price
+        with self.state_lock:
+            self._bump_version(ugrid_id)
         
-        with self.db_lock:
-            conn = get_mysql_connection(DB_NAME)
-            try:
-                cur = conn.cursor()
-                cur.execute("""
-                    INSERT INTO mpc_params (ugrid_id, alpha, beta, gamma, price)
-                    VALUES (%s,%s,%s,%s,%s)
-                    ON DUPLICATE KEY UPDATE alpha=VALUES(alpha), beta=VALUES(beta), 
-                    gamma=VALUES(gamma), price=VALUES(price)
-                """, (ugrid_id, alpha, beta, gamma, price))
-                conn.commit()
-            finally:
-                conn.close()
+        with db_write_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO mpc_params (ugrid_id, alpha, beta, gamma, price)
+                VALUES (%s,%s,%s,%s,%s)
+                ON DUPLICATE KEY UPDATE alpha=VALUES(alpha), beta=VALUES(beta), 
+                gamma=VALUES(gamma), price=VALUES(price)
+            """, (ugrid_id, alpha, beta, gamma, price))
+            conn.commit()
+        self._notify_shared("prices")
         
         # CoAP PUT
-        uconf = UGRIDS.get(ugrid_id)
+        uconf = ugrid_registry.get(ugrid_id)
         if not uconf: return
         host, port, _ = _parse_coap_uri(uconf["coap_state_uri"])
         
@@ -669,15 +3201,99 @@ class RCA:
         except Exception as e:
             logger.error(f"Errore set_mpc_params CoAP: {e}")
 
+    def discovery_loop(self):
+        while not self.engine_stop.wait(DISCOVERY_INTERVAL_SEC if ugrid_registry.all() else 5.0):
+            try:
+                known = {cfg["coap_state_uri"] for cfg in ugrid_registry.all().values()}
+                new = [(ug, uri) for ug, uri in discover_ugrids() if uri not in known]
+                for ugrid_id, uri in new:
+                    ugrid_registry.register(ugrid_id, uri, source="discovery")
+                if new:
+                    self._notify_shared("ugrids")
+            except Exception as e:
+                logger.error(f"Errore discovery uGrid: {e}")
+
+    def retention_loop(self):
+        while not self.engine_stop.is_set():
+            if TELEMETRY_SCHEMA_MODE == "timeseries":
+                try:
+                    maintain_telemetry_partitions()
+                except Exception as e:
+                    logger.error(f"Errore manutenzione partizioni telemetry: {e}")
+            try:
+                purge_rollups()
+            except Exception as e:
+                logger.error(f"Errore retention rollup telemetry: {e}")
+            self.engine_stop.wait(PARTITION_MAINTENANCE_INTERVAL_SEC)
+
     def start(self):
+        # Processo singolo (server dev o waitress): engine e API nello stesso processo.
+        # Con lo sharding serve comunque il sync (lease, snapshot degli altri nodi)
+        if SHARD_ENABLED:
+            self.start_worker()
+        else:
+            self.start_engine()
+
+    def start_worker(self):
+        # Worker gunicorn: API sempre, engine solo se eletto leader (vedi SharedStateSync)
+        self.events.new_epoch()  # l'istanza è creata prima del fork: epoca SSE per worker
+        self.shared = SharedStateSync(self)
+        try:
+            ugrid_registry.load()
+            self.load_objectives()
+            self.load_prices()
+        except Exception as e:
+            logger.error(f"Errore caricamento stato iniziale worker: {e}")
+        self.shared.start()
+
+    def start_engine(self):
+        try:
+            ugrid_registry.load()
+            self.load_objectives()
+            self.load_prices()
+            self.load_latest_status()
+            self.alert_engine.reload()
+            self.alert_engine.load_active()
+        except Exception as e:
+            logger.error(f"Errore caricamento snapshot stato dal DB: {e}")
+        self.engine_stop.clear()
         self.mqtt_pub.start()
+        self.telemetry_writer.start()
         # Thread per il loop di polling (che ora usa chiamate bloccanti)
-        t = threading.Thread(target=self.poll_loop, daemon=True)
-        t.start()
+        self._engine_threads = [
+            threading.Thread(target=self.poll_loop, name="poll", daemon=True),
+            threading.Thread(target=self.retention_loop, name="retention", daemon=True),
+        ]
+        if DISCOVERY_BORDER_ROUTER_URL:
+            self._engine_threads.append(
+                threading.Thread(target=self.discovery_loop, name="discovery", daemon=True))
+        for t in self._engine_threads:
+            t.start()
+
+    def stop_engine(self):
+        if not self._engine_threads:
+            return
+        self.engine_stop.set()
+        self.ingest_queue.put(None)  # sveglia il poll thread
+        for t in self._engine_threads:
+            t.join(POLL_TIMEOUT_SEC + 1.0)
+        self._engine_threads = []
+        for obs in self.observers.values():
+            obs.cancel()
+        self.observers.clear()
+        self.mqtt_pub.stop()
+        self.telemetry_writer.stop()
 
     def stop(self):
         self.stop_event.set()
-        self.mqtt_pub.stop()
+        self.stop_engine()
+        self.poll_executor.shutdown(wait=False, cancel_futures=True)
+        self.dispatcher.stop()
+        if self.shared is not None:
+            self.shared.stop()
+        coap_pool.close_all()
+        db_read_pool.close_all()
+        db_write_pool.close_all()
 
 rca = RCA()
 
@@ -685,18 +3301,210 @@ rca = RCA()
 # API HTTP (Flask)                                              
 # ---------------------------------------------------------------------------
 
+MIME_CBOR = "application/cbor"
+MIME_MSGPACK = "application/msgpack"
+_API_MIMETYPES = ["application/json", MIME_CBOR, MIME_MSGPACK, "application/x-msgpack"]
+
+def _plain_value(v):
+    if isinstance(v, Decimal):
+        return float(v)
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    return str(v)
+
+def columnar(rows: list) -> Dict[str, Any]:
+    # [{k: v}, ...] -> {"columns": [...], "data": {k: [v, ...]}}: i nomi dei campi compaiono una volta
+    columns = list(rows[0].keys()) if rows else []
+    return {"columns": columns, "data": {c: [r.get(c) for r in rows] for c in columns}}
+
+def _response_format() -> str:
+    best = request.accept_mimetypes.best_match(_API_MIMETYPES, default="application/json")
+    if best == MIME_CBOR:
+        return "cbor"
+    if best in (MIME_MSGPACK, "application/x-msgpack") and msgpack is not None:
+        return "msgpack"
+    return "json"
+
+def _compress(body: bytes) -> Tuple[bytes, Optional[str]]:
+    if len(body) < API_COMPRESS_MIN_BYTES:
+        return body, None
+    accepted = request.accept_encodings
+    if zstandard is not None and accepted["zstd"]:
+        return zstandard.ZstdCompressor(level=API_ZSTD_LEVEL).compress(body), "zstd"
+    if accepted["gzip"]:
+        return gzip.compress(body, compresslevel=API_GZIP_LEVEL), "gzip"
+    return body, None
+
+def api_response(obj: Any, series_key: Optional[str] = None, nested_key: Optional[str] = None,
+                 status: int = 200) -> Response:
+    # series_key: nelle codifiche binarie la lista (o obj[series_key]) viene resa colonnare
+    # nested_key: idem per v[nested_key] di ogni valore di un dict ({ugrid_id: {..., batteries: [...]}})
+    fmt = _response_format()
+    if fmt == "json":
+        body = json.dumps(obj, separators=(",", ":"), default=_plain_value).encode("utf-8")
+        mimetype = "application/json"
+    else:
+        if isinstance(obj, list):
+            obj = columnar(obj)
+        elif series_key is not None and isinstance(obj.get(series_key), list):
+            obj = dict(obj, **{series_key: columnar(obj[series_key])})
+        elif nested_key is not None and isinstance(obj, dict):
+            obj = {k: (dict(v, **{nested_key: columnar(v[nested_key])})
+                       if isinstance(v, dict) and isinstance(v.get(nested_key), list) else v)
+                   for k, v in obj.items()}
+        if fmt == "cbor":
+            body = cbor2.dumps(obj, default=lambda enc, v: enc.encode(_plain_value(v)))
+            mimetype = MIME_CBOR
+        else:
+            body = msgpack.packb(obj, default=_plain_value, use_bin_type=True)
+            mimetype = MIME_MSGPACK
+
+    body, encoding = _compress(body)
+    resp = Response(body, status=status, mimetype=mimetype)
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept, Accept-Encoding"
+    return resp
+
+def _json_row(r: Dict[str, Any]) -> Dict[str, Any]:
+    for k, v in r.items():
+        if isinstance(v, datetime):
+            r[k] = v.isoformat()
+    return r
+
+def _wants_ndjson() -> bool:
+    if request.args.get("format") == "ndjson":
+        return True
+    return request.accept_mimetypes.best == "application/x-ndjson"
+
+def keyset_rows_response(table: str, where: str, params: tuple, default_limit: int):
+    # Paginazione a cursore:
+    #   (default)  più recenti per primi, ORDER BY ts DESC, id DESC
+    #   before_id  pagina successiva (più vecchia) rispetto alla riga con quell'id
+    #   after_ts   righe più nuove di after_ts (+ after_id per i pari merito), ORDER BY ts ASC
+    args = request.args
+    stream = _wants_ndjson()
+    try:
+        limit = int(args["limit"]) if "limit" in args else (None if stream else default_limit)
+        before_id = int(args["before_id"]) if "before_id" in args else None
+        after_ts = parse_time_arg(args.get("after_ts"), 0.0) if "after_ts" in args else None
+        after_id = int(args.get("after_id", 0))
+    except ValueError:
+        abort(400, "parametri di paginazione non validi")
+    if not stream:
+        limit = max(0, min(limit, API_MAX_PAGE_SIZE))
+
+    sql_where, sql_params = [where], list(params)
+    ascending = after_ts is not None
+    if ascending:
+        sql_where.append("(ts > FROM_UNIXTIME(%s) OR (ts = FROM_UNIXTIME(%s) AND id > %s))")
+        sql_params += [after_ts, after_ts, after_id]
+    elif before_id is not None:
+        sql_where.append(f"(ts < (SELECT ts FROM {table} WHERE id=%s LIMIT 1) OR "
+                         f"(ts = (SELECT ts FROM {table} WHERE id=%s LIMIT 1) AND id < %s))")
+        sql_params += [before_id, before_id, before_id]
+    order = "ASC" if ascending else "DESC"
+    sql = f"SELECT * FROM {table} WHERE {' AND '.join(sql_where)} ORDER BY ts {order}, id {order}"
+    if limit is not None:
+        sql += " LIMIT %s"
+        sql_params.append(limit)
+
+    if stream:
+        def generate():
+            # cursore non bufferizzato: una riga alla volta, memoria costante
+            with db_read_pool.connection() as conn:
+                cur = conn.cursor(dictionary=True)
+                cur.execute(sql, sql_params)
+                for r in cur:
+                    yield json.dumps(_json_row(r), default=str) + "\n"
+                cur.close()
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    with db_read_pool.connection() as conn:
+        cur = conn.cursor(dictionary=True)
+        cur.execute(sql, sql_params)
+        rows = cur.fetchall()
+    rows = [_json_row(r) for r in rows]
+    resp = api_response(rows)
+    if rows and len(rows) == limit:
+        last = rows[-1]
+        if ascending:
+            resp.headers["X-Next-After-Ts"] = last["ts"]
+            resp.headers["X-Next-After-Id"] = str(last["id"])
+        else:
+            resp.headers["X-Next-Before-Id"] = str(last["id"])
+    return resp
+
 @app.route("/api/status", methods=["GET"])
 def api_status():
-    return jsonify(rca.get_latest_status())
+    since = request.args.get("since")
+    try:
+        since = int(since) if since not in (None, "") else None
+    except ValueError:
+        abort(400, "since invalido")
+
+    instance, version = rca.status_tag()
+    if since is not None and (rca.shard_ring is not None or since > version):
+        since = None  # delta non applicabile: documento completo (vedi get_latest_status)
+    etag = (f"{instance}-{version}" + (f"-since{since}" if since is not None else "")
+            + f"-{_response_format()}")
+    headers = {"X-Status-Version": str(version), "X-Status-Instance": instance}
+    if since is not None:
+        headers["X-Status-Since"] = str(since)  # risposta delta, da unire allo stato del client
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304, headers=headers)
+        resp.set_etag(etag, weak=True)
+        return resp
+
+    resp = api_response(rca.get_latest_status(since=since), nested_key="batteries")
+    resp.headers.update(headers)
+    # weak: lo stesso snapshot può essere servito con Content-Encoding diversi
+    resp.set_etag(etag, weak=True)
+    return resp
+
+@app.route("/api/stream", methods=["GET"])
+def api_stream():
+    # SSE: snapshot iniziale (evento "status") e poi delta per uGrid (evento "ugrid")
+    last_id = rca.events.parse_event_id(
+        request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+
+    def snapshot():
+        eid = rca.events.last_id
+        body = json.dumps(rca.get_latest_status(), separators=(",", ":"), default=str)
+        return f"id: {rca.events.event_id(eid)}\nevent: status\ndata: {body}\n\n", eid
+
+    def generate():
+        after = last_id
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        if after is None:
+            frame, after = snapshot()
+            yield frame
+        while not rca.stop_event.is_set():
+            frames, newest = rca.events.wait(after, SSE_HEARTBEAT_SEC)
+            if frames is None:
+                # troppo indietro per riprendere: nuovo snapshot completo
+                frame, after = snapshot()
+                yield frame
+                continue
+            after = newest
+            yield "".join(frames) if frames else ": heartbeat\n\n"
+
+    if not rca.events.subscribe(SSE_MAX_SUBSCRIBERS):
+        return Response("Troppi stream SSE attivi", status=503, mimetype="text/plain",
+                        headers={"Retry-After": str(SSE_RETRY_MS // 1000)})
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    resp = Response(generate(), mimetype="text/event-stream", headers=headers)
+    # call_on_close: il posto si libera anche se il generatore non parte mai
+    resp.call_on_close(rca.events.unsubscribe)
+    return resp
 
 @app.route("/api/batteries/<ugrid_id>/<int:bat_idx>/objective", methods=["POST", "DELETE"])
 def api_battery_objective(ugrid_id, bat_idx):
-    if ugrid_id not in UGRIDS: abort(404, "uGrid sconosciuto")
+    if ugrid_id not in ugrid_registry: abort(404, "uGrid sconosciuto")
     if request.method == "DELETE":
-        try:
-            clear_ugrid_objective(ugrid_id, bat_idx)
-        except Exception as e:
-            logger.error(f"Errore clear objective: {e}")
+        if rca._engine_threads and rca.owns_ugrid(ugrid_id):
+            rca.dispatcher.submit(ugrid_id, bat_idx, clear=True)
+        # altrimenti il clear lo invia il processo che comanda la uGrid (load_objectives)
         rca.delete_objective(ugrid_id, bat_idx)
         return jsonify({"status": "ok"})
 
@@ -714,31 +3522,67 @@ def api_battery_objective(ugrid_id, bat_idx):
 
 @app.route("/api/batteries/<ugrid_id>/<int:bat_idx>/history", methods=["GET"])
 def api_battery_history(ugrid_id, bat_idx):
-    limit = int(request.args.get("limit", 100))
-    with rca.db_lock:
-        conn = get_mysql_connection(DB_NAME)
-        try:
-            cur = conn.cursor(dictionary=True)
-            cur.execute("SELECT * FROM telemetry WHERE ugrid_id=%s AND battery_index=%s ORDER BY ts DESC LIMIT %s", 
-                        (ugrid_id, bat_idx, limit))
-            rows = cur.fetchall()
-        finally:
-            conn.close()
-    for r in rows: r["ts"] = r["ts"].isoformat()
-    return jsonify(rows)
+    args = request.args
+    if any(k in args for k in ("from", "to", "step", "agg")):
+        return api_battery_history_series(ugrid_id, bat_idx)
+
+    return keyset_rows_response("telemetry", "ugrid_id=%s AND battery_index=%s",
+                                (ugrid_id, bat_idx), default_limit=100)
+
+def api_battery_history_series(ugrid_id, bat_idx):
+    args = request.args
+    now = time.time()
+    try:
+        end_ts = parse_time_arg(args.get("to"), now)
+        start_ts = parse_time_arg(args.get("from"), end_ts - 86400.0)
+        points = min(int(args.get("points", HISTORY_DEFAULT_POINTS)), HISTORY_MAX_POINTS)
+        step = float(args.get("step", 0))
+    except ValueError:
+        abort(400, "parametri from/to/step/points non validi")
+    agg = args.get("agg", "avg")
+    if agg not in HISTORY_AGGS: abort(400, "agg invalido")
+    if end_ts <= start_ts or points < 1: abort(400, "intervallo vuoto")
+    lttb_field = args.get("field", "soc")
+    if lttb_field not in ROLLUP_METRICS: abort(400, "field invalido")
+
+    # il numero di punti restituiti è limitato da 'points', non dall'ampiezza dell'intervallo
+    step = max(step, (end_ts - start_ts) / points)
+    with db_read_pool.connection() as conn:
+        series = query_battery_series(conn, ugrid_id, bat_idx, start_ts, end_ts,
+                                      step, agg, points, lttb_field)
+    return api_response(series, series_key="points")
+
+@app.route("/api/ugrids", methods=["GET", "POST"])
+def api_ugrids():
+    if request.method == "GET":
+        return jsonify(ugrid_registry.all())
+
+    data = request.get_json(force=True, silent=True) or {}
+    ugrid_id = data.get("ugrid_id")
+    uri = data.get("coap_state_uri")
+    if not ugrid_id or not uri: abort(400, "ugrid_id e coap_state_uri obbligatori")
+    try:
+        ok = ugrid_registry.register(str(ugrid_id), str(uri))
+    except ValueError:
+        abort(400, "coap_state_uri invalido")
+    if not ok: abort(409, "coap_state_uri già registrato con un altro ugrid_id")
+    rca._notify_shared("ugrids")
+    return jsonify({"status": "ok", "ugrid_id": ugrid_id}), 201
+
+@app.route("/api/ugrids/<ugrid_id>", methods=["DELETE"])
+def api_ugrid_delete(ugrid_id):
+    if not ugrid_registry.unregister(ugrid_id): abort(404, "uGrid sconosciuto")
+    rca._notify_shared("ugrids")
+    return jsonify({"status": "ok"})
 
 @app.route("/api/ugrids/<ugrid_id>/mpc_params", methods=["POST", "GET"])
 def api_mpc_params(ugrid_id):
-    if ugrid_id not in UGRIDS: abort(404, "uGrid sconosciuto")
+    if ugrid_id not in ugrid_registry: abort(404, "uGrid sconosciuto")
     if request.method == "GET":
-        with rca.db_lock:
-            conn = get_mysql_connection(DB_NAME)
-            try:
-                cur = conn.cursor(dictionary=True)
-                cur.execute("SELECT * FROM mpc_params WHERE ugrid_id=%s", (ugrid_id,))
-                row = cur.fetchone()
-            finally:
-                conn.close()
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor(dictionary=True, buffered=True)
+            cur.execute("SELECT * FROM mpc_params WHERE ugrid_id=%s", (ugrid_id,))
+            row = cur.fetchone()
         if not row: abort(404)
         row["updated_at"] = row["updated_at"].isoformat()
         return jsonify(row)
@@ -753,25 +3597,119 @@ def api_mpc_params(ugrid_id):
     rca.set_mpc_params(ugrid_id, a, b, g, p)
     return jsonify({"status": "ok"})
 
+@app.route("/api/stats", methods=["GET"])
+def api_stats():
+    return jsonify({
+        "db_read_pool": db_read_pool.stats(), "db_write_pool": db_write_pool.stats(),
+        "coap_pool": coap_pool.stats(), "telemetry_writer": rca.telemetry_writer.stats(),
+        "poll_scheduler": rca.poll_scheduler.stats(), "alert_engine": rca.alert_engine.stats(),
+        "mqtt": rca.mqtt_pub.stats(), "objective_dispatcher": rca.dispatcher.stats(),
+        "locks": {lk.name: lk.stats() for lk in (rca.state_lock, rca.objectives_lock)},
+    })
+
+@app.route("/api/alert_rules", methods=["GET", "POST"])
+def api_alert_rules():
+    if request.method == "GET":
+        with db_read_pool.connection() as conn:
+            cur = conn.cursor(dictionary=True)
+            cur.execute("SELECT * FROM alert_rules ORDER BY rule_id, ugrid_id, battery_index")
+            rows = [_json_row(r) for r in cur.fetchall()]
+            cur.close()
+        return jsonify(rows)
+
+    # Upsert per (rule_id, ugrid_id, battery_index): senza scope è la regola globale
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        row = (str(data["rule_id"]), str(data.get("ugrid_id") or ""), int(data.get("battery_index", -1)),
+               data.get("level", "warning"), data["field"], data.get("kind", "threshold"), data["op"],
+               float(data["enter"]), float(data["exit"]), str(data.get("message") or data["rule_id"]),
+               bool(data.get("enabled", True)))
+    except (KeyError, TypeError, ValueError):
+        abort(400, "regola incompleta")
+    _, _, _, level, field, kind, op, enter, exit_, message, _ = row
+    if (level not in ALERT_LEVELS or field not in BATT_FIELDS_COLUMNS
+            or kind not in ("threshold", "rate") or op not in ("<", ">")):
+        abort(400, "regola invalida")
+    if (op == "<" and exit_ < enter) or (op == ">" and exit_ > enter):
+        abort(400, "isteresi invalida: exit deve stare dal lato sicuro di enter")
+    try:
+        message.format(value=0.0)
+    except (KeyError, IndexError, ValueError):
+        abort(400, "message invalido (unico segnaposto ammesso: {value})")
+
+    with db_write_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO alert_rules (rule_id, ugrid_id, battery_index, level, field, kind, op,
+                                     enter_value, exit_value, message, enabled)
+            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+            ON DUPLICATE KEY UPDATE level=VALUES(level), field=VALUES(field), kind=VALUES(kind),
+                op=VALUES(op), enter_value=VALUES(enter_value), exit_value=VALUES(exit_value),
+                message=VALUES(message), enabled=VALUES(enabled)
+        """, row)
+        cur.close()
+    _reload_alert_rules()
+    return jsonify({"status": "ok"})
+
+@app.route("/api/alert_rules/<int:row_id>", methods=["DELETE"])
+def api_alert_rule_delete(row_id):
+    with db_write_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM alert_rules WHERE id=%s", (row_id,))
+        found = cur.rowcount > 0
+        cur.close()
+    if not found: abort(404)
+    _reload_alert_rules()
+    return jsonify({"status": "ok"})
+
+def _reload_alert_rules():
+    if rca.owns_state:
+        rca.alert_engine.reload()
+    rca._notify_shared("alert_rules")
+
 @app.route("/api/alerts", methods=["GET"])
 def api_alerts():
-    limit = int(request.args.get("limit", 50))
-    with rca.db_lock:
-        conn = get_mysql_connection(DB_NAME)
-        try:
-            cur = conn.cursor(dictionary=True)
-            cur.execute("SELECT * FROM alerts ORDER BY ts DESC LIMIT %s", (limit,))
-            rows = cur.fetchall()
-        finally:
-            conn.close()
-    for r in rows: r["ts"] = r["ts"].isoformat()
-    return jsonify(rows)
+    # ?state=active|resolved filtra per stato dell'incidente
+    state = request.args.get("state")
+    if state is None:
+        return keyset_rows_response("alerts", "1=1", (), default_limit=50)
+    if state not in ("active", "resolved"): abort(400, "state invalido")
+    return keyset_rows_response("alerts", "state=%s", (state,), default_limit=50)
 
 # ---------------------------------------------------------------------------
 # MAIN
 # ---------------------------------------------------------------------------
+def serve_gunicorn():
+    # Import locale: gunicorn serve solo in modalità multi-processo
+    from gunicorn.app.base import BaseApplication
+
+    class RcaGunicorn(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{HTTP_HOST}:{HTTP_PORT}")
+            self.cfg.set("workers", HTTP_WORKERS)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", HTTP_THREADS)
+            self.cfg.set("timeout", HTTP_WORKER_TIMEOUT_SEC)
+            self.cfg.set("post_fork", lambda server, worker: rca.start_worker())
+            self.cfg.set("worker_exit", lambda server, worker: rca.stop())
+
+        def load(self):
+            return app
+
+    # Il master non deve passare ai worker connessioni MySQL già aperte
+    db_read_pool.close_all()
+    db_write_pool.close_all()
+    RcaGunicorn().run()
+
+
 def main():
     init_database()
+
+    if HTTP_SERVER == "gunicorn":
+        # Segnali gestiti da gunicorn, engine avviato nel worker leader
+        serve_gunicorn()
+        return
+
     rca.start()
     
     # ctrl+C handler
@@ -783,8 +3721,12 @@ def main():
     signal.signal(signal.SIGINT, handle_sig)
     signal.signal(signal.SIGTERM, handle_sig)
     
-    # Flask gestito nel main thread
-    app.run(host="0.0.0.0", port=3000, debug=False, threaded=True)
+    if HTTP_SERVER == "waitress":
+        from waitress import serve
+        serve(app, host=HTTP_HOST, port=HTTP_PORT, threads=HTTP_THREADS)
+    else:
+        # Flask gestito nel main thread
+        app.run(host=HTTP_HOST, port=HTTP_PORT, debug=False, threaded=True)
 
 if __name__ == "__main__":
     main()
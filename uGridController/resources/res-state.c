@@ -11,6 +11,11 @@ extern int battery_count;
 extern float curr_load;
 extern float curr_pv;
 extern battery_node_t batteries[];
+extern coap_resource_t res_ugrid_state;
+
+static void res_state_event_handler(void) {
+    coap_notify_observers(&res_ugrid_state);
+}
 
     static void
 res_get_state_h(coap_message_t *req, coap_message_t *res,
@@ -79,5 +84,11 @@ res_get_state_h(coap_message_t *req, coap_message_t *res,
     coap_set_payload(res, buf, (uint16_t)out_len);
 }
 
-RESOURCE(res_ugrid_state, "title=\"State\"", res_get_state_h, NULL, NULL, NULL);
+EVENT_RESOURCE(res_ugrid_state,
+               "title=\"State\";obs",
+               res_get_state_h,
+               NULL,
+               NULL,
+               NULL,
+               res_state_event_handler);
 
@@ -478,6 +478,10 @@ PROCESS_THREAD(ugrid_controller, ev, data) {
 
             print_battery_status();
 
+            // notify observers (RCA) at the end of each MPC cycle, via the
+            // EVENT_RESOURCE trigger (res_state_event_handler)
+            res_ugrid_state.trigger();
+
             etimer_reset(&et_compute);
             leds_off(LEDS_BLUE);
         }